@@ -0,0 +1,253 @@
+# Usage:
+#
+# python3 benchmark.py [--quick] [--output results.json] [--baseline baseline.json]
+#
+# Benchmarks the parts of Spigot that matter for performance:
+#
+#   build      MarkovChain() build time and peak (tracemalloc) memory
+#   generate   MarkovChain.generate() at several lengths and memory sizes
+#   spigot     Spigot.pagetext(), Spigot.page() and the top page, the
+#              latter two through the Flask test client, and pages in
+#              the other generation modes
+#   loadmgr    LoadManager round trips per second with N threads
+#              contending for it
+#
+# Everything is seeded, so each run does the same work. Each timing is
+# the median of several rounds. Results are printed and, with --output,
+# written as JSON; keep one as a baseline, and later runs given
+# --baseline will report any result that's more than --tolerance
+# (default 15%) worse than it, and exit with status 1.
+#
+# --only build,generate runs just the named groups. --quick runs fewer,
+# shorter rounds, for a rough idea.
+#
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+import markovchain
+from markovchain import MarkovChain
+from loadmanager import LoadManager
+
+HOME = os.path.dirname(os.path.realpath(__file__))
+CORPUS = f"{HOME}/markov_input.txt"
+
+GENERATE_MEMORIES = (3, 5, 8)
+GENERATE_LENGTHS = (1000, 5000, 20000)
+BUILD_MEMORIES = (3, 8)
+LOADMGR_THREADS = (1, 4, 16)
+
+# Call fn repeatedly for about round_time seconds, rounds times, and
+# return the median time per call.
+def timeit(fn, rounds, round_time):
+    times = []
+    for _ in range(rounds):
+        n = 0
+        start = time.perf_counter()
+        while True:
+            fn()
+            n += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= round_time:
+                break
+        times.append(elapsed / n)
+    return statistics.median(times)
+
+# A result: value, its unit, and whether bigger is better.
+def result(value, unit, higher_is_better):
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+def bench_build(results, rounds, round_time):
+    for memory in BUILD_MEMORIES:
+        for compact in (False, True):
+            name = f"build/memory={memory}/{'compact' if compact else 'dict'}"
+            times = []
+            for _ in range(max(1, rounds // 2)):
+                start = time.perf_counter()
+                MarkovChain(CORPUS, memory, compact=compact)
+                times.append(time.perf_counter() - start)
+            tracemalloc.start()
+            mc = MarkovChain(CORPUS, memory, compact=compact)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del mc
+            results[f"{name}/seconds"] = result(statistics.median(times), "s", False)
+            results[f"{name}/peak_mb"] = result(peak / 1e6, "MB", False)
+            results[f"{name}/resident_mb"] = result(current / 1e6, "MB", False)
+
+def bench_generate(results, rounds, round_time):
+    for memory in GENERATE_MEMORIES:
+        mc = MarkovChain(CORPUS, memory)
+        for length in GENERATE_LENGTHS:
+            rng = random.Random(42)
+            per_call = timeit(lambda: mc.generate(length, "Sherlock", rng=rng), rounds, round_time)
+            results[f"generate/memory={memory}/length={length}"] = result(length / per_call, "chars/s", True)
+
+    # The other generation modes, at the default page length, and the
+    # default memory size (or a sensible one, for words).
+    length = 20000
+    modes = {
+        "runs": (8, {"collapse_runs": True}),
+        "words": (2, {"words": True}),
+    }
+    if markovchain.np is not None:
+        modes["numpy"] = (8, {"use_numpy": True})
+    for mode, (memory, kwargs) in modes.items():
+        mc = MarkovChain(CORPUS, memory, **kwargs)
+        rng = random.Random(42)
+        per_call = timeit(lambda: mc.generate(length, "Sherlock", rng=rng), rounds, round_time)
+        results[f"generate/memory={memory}/length={length}/{mode}"] = result(length / per_call, "chars/s", True)
+
+def bench_spigot(results, rounds, round_time):
+    from spigot import Spigot
+
+    # No CPU limit, so this measures generation rather than throttling.
+    app = Spigot("http://localhost/", home_dir=HOME, max_cpu_percent=10**6)
+    client = app.test_client()
+
+    rng = random.Random(42)
+    per_call = timeit(lambda: app.pagetext(rng), rounds, round_time)
+    results["spigot/pagetext"] = result(1 / per_call, "calls/s", True)
+
+    stamp = int(time.time()) - 86400
+    per_call = timeit(lambda: app.datedlink(stamp, rng=rng), rounds, round_time)
+    results["spigot/datedlink"] = result(1 / per_call, "calls/s", True)
+    app.short_link_titles = True
+    per_call = timeit(lambda: app.datedlink(stamp, rng=rng), rounds, round_time)
+    results["spigot/datedlink/short"] = result(1 / per_call, "calls/s", True)
+    app.short_link_titles = False
+
+    locations = [f"{2020 + i % 5}/0{1 + i % 9}/1{i % 10}/page_{i}/" for i in range(1000)]
+    def pages(client):
+        n = 0
+        def page():
+            nonlocal n
+            client.get(locations[n % len(locations)]).close()
+            n += 1
+        return page
+    per_call = timeit(pages(client), rounds, round_time)
+    results["spigot/page"] = result(1 / per_call, "requests/s", True)
+
+    # Whole pages in the other generation modes, with and without short
+    # link titles, as a page's few short walks (its title and links)
+    # cost more than one long one of the same length.
+    modes = {"runs": {"markov_collapse_runs": True}}
+    if markovchain.np is not None:
+        modes["numpy"] = {"markov_numpy": True}
+    for mode, kwargs in modes.items():
+        for short in (False, True):
+            mode_app = Spigot("http://localhost/", home_dir=HOME, max_cpu_percent=10**6, short_link_titles=short, **kwargs)
+            per_call = timeit(pages(mode_app.test_client()), rounds, round_time)
+            results[f"spigot/page/{mode}{'/short' if short else ''}"] = result(1 / per_call, "requests/s", True)
+
+    # Throw away the cached top page each time, so it's rebuilt.
+    def top():
+        app.top_cache = None
+        client.get("/").close()
+    per_call = timeit(top, rounds, round_time)
+    results["spigot/top_router"] = result(1 / per_call, "requests/s", True)
+
+    per_call = timeit(lambda: client.get("/").close(), rounds, round_time)
+    results["spigot/top_router/cached"] = result(1 / per_call, "requests/s", True)
+
+def bench_loadmgr(results, rounds, round_time):
+    for nthreads in LOADMGR_THREADS:
+        # A high CPU target, so the bucket never throttles and we see the
+        # cost of the locking itself.
+        lm = LoadManager(target_pcpu=100 * nthreads * 1000, slots=1)
+        counts = []
+        for _ in range(rounds):
+            stop = threading.Event()
+            done = [0] * nthreads
+            def worker(i):
+                while not stop.is_set():
+                    with lm:
+                        sum(range(100))
+                    done[i] += 1
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(nthreads)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            time.sleep(round_time)
+            stop.set()
+            for t in threads:
+                t.join()
+            counts.append(sum(done) / (time.perf_counter() - start))
+        results[f"loadmgr/threads={nthreads}"] = result(statistics.median(counts), "ops/s", True)
+
+BENCHMARKS = {
+    "build": bench_build,
+    "generate": bench_generate,
+    "spigot": bench_spigot,
+    "loadmgr": bench_loadmgr,
+}
+
+# Compare results with a baseline, returning a list of regressions.
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, base in baseline["results"].items():
+        if name not in results:
+            continue
+        value = results[name]["value"]
+        # change is positive for an improvement either way.
+        if base["higher_is_better"]:
+            change = value / base["value"] - 1
+        else:
+            change = 1 - value / base["value"]
+        worse = change < -tolerance
+        flag = "REGRESSION" if worse else ""
+        print(f"{name:45} {base['value']:>14.4g} -> {value:<14.4g} {change*100:+6.1f}% {flag}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Spigot")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare results with this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed fractional slowdown")
+    parser.add_argument("--only", help="comma separated benchmark groups to run")
+    parser.add_argument("--quick", action="store_true", help="fewer, shorter rounds")
+    args = parser.parse_args()
+
+    rounds, round_time = (3, 0.2) if args.quick else (5, 1.0)
+    groups = args.only.split(",") if args.only else list(BENCHMARKS)
+    for group in groups:
+        if group not in BENCHMARKS:
+            parser.error(f"unknown benchmark group {group}")
+
+    results = {}
+    for group in groups:
+        print(f"Running {group}...", file=sys.stderr)
+        BENCHMARKS[group](results, rounds, round_time)
+
+    for name, r in results.items():
+        print(f"{name:45} {r['value']:>14.4g} {r['unit']}")
+
+    output = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": int(time.time()),
+        "quick": args.quick,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {args.baseline}:")
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# Usage:
+#
+# page = EncodedPage(content, ENCODINGS)
+# body = page.body("gzip")      # or "br", or None for the plain text
+#
+# A generated page along with its compressed forms, made once so they
+# can be kept (in a PageCache or PagePool) and sent on every later hit
+# without compressing again. len() is the total size of all the forms,
+# so a cache limits the bytes actually held.
+#
+# ENCODINGS lists the content codings available, best first: brotli
+# ("br") if the brotli module is installed, then gzip. gzip output uses
+# a fixed mtime, so it's the same each time for the same page.
+#
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+def compress(data, encoding):
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    raise Exception(f"Unknown content encoding {encoding}")
+
+class EncodedPage:
+    def __init__(self, text, encodings=ENCODINGS):
+        self.encodings = tuple(encodings)
+        data = text.encode("utf-8")
+        self.bodies = {None: data}
+        for encoding in self.encodings:
+            self.bodies[encoding] = compress(data, encoding)
+        self.size = sum(len(body) for body in self.bodies.values())
+
+    def body(self, encoding=None):
+        return self.bodies[encoding]
+
+    @property
+    def text(self):
+        return self.bodies[None].decode("utf-8")
+
+    def __len__(self):
+        return self.size
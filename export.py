@@ -0,0 +1,139 @@
+# Usage:
+#
+# python3 export.py --store /var/lib/spigot/store [--depth 3] [--pages 20000]
+#                   [--processes 4] [--spigot '{...}'] [--if-stale] top_url
+#
+# Renders pages in advance into a PageStore (see pagestore.py), for a
+# Spigot given page_store to send instead of generating them. Crawlers
+# mostly follow links Spigot made itself, so we do the same: starting
+# from the links on the top page, pages are rendered and their links
+# followed, breadth first, to --depth links deep or until --pages pages
+# have been rendered. The work is spread over --processes processes
+# (by default, one per CPU), forked from this one after the model's
+# been loaded. The pages are compressed too, if compress_pages is set.
+#
+# The Spigot here must be set up like the one serving the pages: pass
+# the same arguments (other than top_url, and apart from the load
+# related ones, which don't matter here) as JSON with --spigot. Pages
+# are only used while the model, templates, options and page_cache_days
+# window they were rendered for are current, so run this at the start
+# of each window, e.g. daily from cron for the default page_cache_days
+# of 1.
+# With --if-stale, nothing's done if the store is already current.
+#
+# page_post_hook isn't called for exported pages, and they don't count
+# towards the load manager's CPU target.
+#
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from urllib.parse import unquote
+
+from spigot import Spigot
+import pagestore
+
+HOME = os.path.dirname(os.path.realpath(__file__))
+
+# The Spigot and export directory, in each worker process.
+_app = None
+_directory = None
+
+def _init(app, directory):
+    global _app, _directory
+    _app = app
+    _directory = directory
+
+# Render and store a page, returning the locations it links to.
+def _export(location):
+    with _app.app_context():
+        if _app.stream_pages:
+            content = "".join(_app.page_stream(location))
+        else:
+            content = _app.page(location)
+        pagestore.write_page(_directory, location, _app.encode(content))
+    return links(_app.top_url, content)
+
+# The locations of the pages linked to from some content, as page_router
+# would be given them: unquoted, with repeated slashes merged.
+def links(top_url, content):
+    prefix = top_url + "/"
+    found = []
+    for href in re.findall(r'href="([^"]*)"', content):
+        if href.startswith(prefix):
+            location = re.sub("/+", "/", unquote(href[len(prefix):])).lstrip("/")
+            if location:
+                found.append(location)
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description="Render Spigot pages into a page store")
+    parser.add_argument("top_url", help="the Spigot's top_url")
+    parser.add_argument("--store", required=True, help="page store directory")
+    parser.add_argument("--depth", type=int, default=3, help="how many links deep to go from the top page")
+    parser.add_argument("--pages", type=int, default=10000, help="most pages to render")
+    parser.add_argument("--processes", type=int, default=0, help="processes to render with (0 for one per CPU)")
+    parser.add_argument("--spigot", default="{}", help="JSON object of other Spigot arguments")
+    parser.add_argument("--if-stale", action="store_true", help="only export if the store isn't current")
+    args = parser.parse_args()
+
+    kwargs = {"home_dir": HOME}
+    kwargs.update(json.loads(args.spigot))
+    app = Spigot(args.top_url.rstrip("/"), **kwargs)
+
+    window = app.roundedtime(app.page_cache_days)
+    key = app.etag("", window)
+    manifest = pagestore.read_manifest(args.store)
+    if args.if_stale and manifest is not None and manifest["key"] == key:
+        print(f"{args.store} is up to date", file=sys.stderr)
+        return
+
+    os.makedirs(args.store, exist_ok=True)
+    export = f"{window}-{key[:12]}-{int(time.time())}"
+    directory = os.path.join(args.store, export)
+    os.makedirs(directory)
+
+    with app.app_context():
+        top = app.top_page()
+
+    start = time.time()
+    seen = set()
+    level = []
+    for location in links(app.top_url, top):
+        if location not in seen:
+            seen.add(location)
+            level.append(location)
+    level = level[:args.pages]
+    count = 0
+
+    context = multiprocessing.get_context("fork")
+    with context.Pool(args.processes or None, initializer=_init, initargs=(app, directory)) as pool:
+        for depth in range(1, args.depth + 1):
+            following = []
+            for found in pool.imap(_export, level, chunksize=16):
+                count += 1
+                for location in found:
+                    if location not in seen and len(seen) < args.pages:
+                        seen.add(location)
+                        following.append(location)
+            print(f"Depth {depth}: {len(level)} pages, {count} in total, {time.time() - start:.1f}s", file=sys.stderr)
+            level = following
+            if not level:
+                break
+
+    pagestore.publish(args.store, export, {
+        "key": key,
+        "window": window,
+        "expires": window + app.page_cache_days*86400,
+        "version": app.markov.version,
+        "encodings": list(app.page_encodings),
+        "pages": count,
+        "created": int(time.time()),
+    })
+    print(f"Exported {count} pages to {directory}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
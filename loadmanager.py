@@ -1,41 +1,178 @@
 # Usage:
 #
-# lm = LoadManager(max_queue_len = 10, target_pcpu = 50)
+# lm = LoadManager(max_queue_len = 10, target_pcpu = 50, slots = 1)
 #
 # # Inside a bunch of threads:
 # with lm:
 #   do_some_heavy_processing()
 #
-# This will permit only a single thread to call do_some_heavy_processing,
-# and, on exit from the context, a time.sleep() will be called to enforce
-# an overall average CPU usage over the "with" elapsed time.
+# This will permit only "slots" threads at a time to call
+# do_some_heavy_processing. The CPU time used inside the "with" is
+# measured and charged to a token bucket, shared by all the slots,
+# which refills at target_pcpu percent of one CPU (so target_pcpu can
+# be over 100 if slots > 1). On exit from the context, if the bucket is
+# in debt, a time.sleep() will be called until it's paid off, to
+# enforce an overall average CPU usage. The sleeping thread keeps its
+# slot, but no lock is held while sleeping, so the other slots carry on.
 #
-# If more than max_queue_len threads are waiting for the lock, then the
-# queue.Full exception will be raised. Setting max_queue_len to zero
-# effectively sets an infinite queue.
-#   
+# burst is the number of CPU seconds that can be banked while idle. With
+# the default of zero and a single slot, this behaves like the original
+# single lock version, except that time spent blocked (e.g. writing to
+# a slow client) isn't counted as CPU.
+#
+# If work is done on a thread's behalf somewhere else, such as in another
+# process, add it to the thread's bill with lm.charge(cpu_seconds) before
+# leaving the context.
+#
+# observe_wait and observe_sleep, if given, are called with the number of
+# seconds each thread spent waiting for a slot and sleeping afterwards.
+#
+# If more than max_queue_len threads are waiting for or holding a slot,
+# then the queue.Full exception will be raised. Setting max_queue_len to
+# zero effectively sets an infinite queue.
+#
+# Free slots go to waiting threads in order of priority (lowest number
+# first; see the PRIORITY_* constants), then in order of arrival. A
+# thread that has waited for more than max_wait seconds (zero for no
+# limit) gives up, raising Expired, which is a kind of queue.Full; these
+# are counted in lm.expired. Both can be given for each use:
+#
+# with lm(priority = PRIORITY_LOW, max_wait = 5):
+#   do_some_background_processing()
+#
+# With force set, neither max_queue_len nor max_wait applies, for work
+# that has to be finished once it's been started.
+#
+import heapq
+import itertools
 import queue
 import threading
 import time
 
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITY_ABUSIVE = 3
+
+class Expired(queue.Full):
+    pass
+
 class LoadManager:
-    def __init__(self, max_queue_len=0, target_pcpu=100):
-        self.lock = threading.Lock()
-        self.queue = queue.Queue(max_queue_len)
+    def __init__(self, max_queue_len=0, target_pcpu=100, slots=1, burst=0,
+                observe_wait=None, observe_sleep=None, max_wait=0):
+        self.max_queue_len = max_queue_len
+        self.max_wait = max_wait
+        self.slot_lock = threading.Condition()
+        self.free = slots
+        self.count = 0
+        self.waiters = []
+        self.arrivals = itertools.count()
+        self.expired = 0
         self.target_pcpu = target_pcpu
+        self.rate = target_pcpu / 100
+        self.burst = burst
+        self.bucket_lock = threading.Lock()
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.active = 0
+        self.local = threading.local()
+        self.observe_wait = observe_wait
+        self.observe_sleep = observe_sleep
+
+    # Top up the bucket for the time since it was last updated. Only
+    # idle time is limited by burst: time spent working has to be
+    # credited in full, or each piece of work would be charged its
+    # CPU time without the refill that happened while it ran.
+    # Call with bucket_lock held.
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens += (now - self.updated) * self.rate
+        if self.active == 0:
+            self.tokens = min(self.tokens, self.burst)
+        self.updated = now
+
+    # Set the priority and maximum wait for this thread's next use of the
+    # context.
+    def __call__(self, priority=PRIORITY_NORMAL, max_wait=None, force=False):
+        self.local.priority = priority
+        self.local.max_wait = max_wait
+        self.local.force = force
+        return self
+
+    # Wait for a free slot, unless there are too many waiting already.
+    def _acquire(self):
+        priority = getattr(self.local, "priority", None)
+        max_wait = getattr(self.local, "max_wait", None)
+        force = getattr(self.local, "force", False)
+        self.local.priority = self.local.max_wait = None
+        self.local.force = False
+        if priority is None:
+            priority = PRIORITY_NORMAL
+        if max_wait is None:
+            max_wait = self.max_wait
+        if force:
+            max_wait = 0
+
+        start = time.monotonic()
+        with self.slot_lock:
+            if self.max_queue_len and self.count >= self.max_queue_len and not force:
+                raise queue.Full
+            self.count += 1
+            entry = (priority, next(self.arrivals))
+            heapq.heappush(self.waiters, entry)
+            while self.free == 0 or self.waiters[0] is not entry:
+                timeout = None
+                if max_wait:
+                    timeout = start + max_wait - time.monotonic()
+                    if timeout <= 0:
+                        self.waiters.remove(entry)
+                        heapq.heapify(self.waiters)
+                        self.count -= 1
+                        self.expired += 1
+                        self.slot_lock.notify_all()
+                        raise Expired
+                self.slot_lock.wait(timeout)
+            heapq.heappop(self.waiters)
+            self.free -= 1
+            if self.free > 0 and self.waiters:
+                self.slot_lock.notify_all()
+        if self.observe_wait is not None:
+            self.observe_wait(time.monotonic() - start)
+
+    def _release(self):
+        with self.slot_lock:
+            self.free += 1
+            self.count -= 1
+            self.slot_lock.notify_all()
 
     def __enter__(self):
-        self.queue.put(1, block=False)
-        self.lock.acquire()
-        self.start_time = time.time()
+        self._acquire()
+        with self.bucket_lock:
+            self._refill()
+            self.active += 1
+        self.local.charged = 0.0
+        self.local.start_cpu = time.thread_time()
+
+    def charge(self, cpu_seconds):
+        self.local.charged += cpu_seconds
 
     def __exit__(self, type, value, traceback):
-        elapsed = time.time() - self.start_time
-        sleeptime = elapsed*100/self.target_pcpu - elapsed
-        if sleeptime > 0:
-            time.sleep(sleeptime)
-        self.lock.release()
-        self.queue.get()
+        cpu = time.thread_time() - self.local.start_cpu + self.local.charged
+
+        # Take this thread's CPU usage out of the bucket.
+        with self.bucket_lock:
+            self._refill()
+            self.active -= 1
+            self.tokens -= cpu
+            debt = -self.tokens
+
+        # Sleep until the refill rate has paid off the debt, including
+        # that of any other threads that have just finished.
+        if debt > 0:
+            time.sleep(debt / self.rate)
+        if self.observe_sleep is not None:
+            self.observe_sleep(max(debt / self.rate, 0))
+        self._release()
 
     def waiting(self):
-        return self.queue.qsize()
+        return self.count
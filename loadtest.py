@@ -0,0 +1,323 @@
+# Usage:
+#
+# python3 loadtest.py --crawl [--concurrency 16] [--rate 50] [--duration 60]
+# python3 loadtest.py --log access.log --prefix /spigot-example [--speed 10]
+#
+# Runs a Spigot under a local threaded WSGI server (wsgiref) and throws
+# traffic at it, to see how it copes with crawler-like load rather than
+# the single calls benchmark.py times. Everything happens on 127.0.0.1,
+# so it runs offline. The clients share the process with the server,
+# but the LoadManager only counts the CPU time of the threads generating
+# pages, so its CPU limit still applies as it would in production.
+#
+# The traffic comes from one of:
+#
+#   --crawl    a synthetic crawler, which starts at the top page and
+#              follows the links in each page it fetches, so it goes
+#              deep, and every so often (--revisit) fetches a page it's
+#              already seen again
+#   --log      an Apache combined format access log. Requests for paths
+#              under --prefix are replayed (with the prefix removed), in
+#              order. With --speed, they're sent with the same timing as
+#              in the log, that many times faster.
+#
+# --concurrency clients send requests, at no more than --rate requests
+# per second in total (zero for as fast as they can). The run stops
+# after --duration seconds, --requests requests, or at the end of the
+# log.
+#
+# Every --interval seconds, and at the end, the throughput, latency
+# percentiles, proportion of 503 responses, and the LoadManager's queue
+# depth (mean and max, sampled every 100ms) are printed. --output writes
+# the lot as JSON.
+#
+# Spigot is given home_dir and a top_url; anything else can be passed as
+# JSON with --spigot, e.g. to try different limits:
+#
+# python3 loadtest.py --crawl --spigot '{"max_thread_queue_len": 10, "max_cpu_percent": 50}'
+#
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+from spigot import Spigot
+
+HOME = os.path.dirname(os.path.realpath(__file__))
+TOP_URL = "http://spigot.test"
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+# Requests from an Apache combined format log. next() returns each
+# request's time offset from the first (or None, without speed) and path.
+class LogReplay:
+    LINE = re.compile(r'^\S+ \S+ \S+ \[([^\]]+)\] "(\S+) (\S+)[^"]*"')
+
+    def __init__(self, filename, prefix="/", speed=0):
+        self.speed = speed
+        self.entries = []
+        self.lock = threading.Lock()
+        self.pos = 0
+        prefix = prefix.rstrip("/")
+        first = None
+        with open(filename, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                m = self.LINE.match(line)
+                if m is None or m.group(2) not in ("GET", "HEAD"):
+                    continue
+                path = m.group(3)
+                if not path.startswith(prefix + "/"):
+                    continue
+                stamp = datetime.strptime(m.group(1), "%d/%b/%Y:%H:%M:%S %z")
+                if first is None:
+                    first = stamp
+                self.entries.append(((stamp - first).total_seconds(), path[len(prefix):]))
+        if not self.entries:
+            raise Exception(f"No requests under {prefix}/ in {filename}")
+
+    def next(self, state):
+        with self.lock:
+            if self.pos >= len(self.entries):
+                return None
+            offset, path = self.entries[self.pos]
+            self.pos += 1
+        return (offset / self.speed if self.speed else None), path
+
+    def visited(self, state, path, status, body):
+        pass
+
+# A crawler that follows links. Each client follows a link from the
+# last page it fetched, so it works its way deeper into the tree, and
+# now and then goes back to a page some client has seen already.
+class Crawler:
+    LINK = re.compile(r'href="([^"]*)"')
+
+    def __init__(self, top_url=TOP_URL, revisit=0.1, max_seen=100000):
+        self.top_url = top_url
+        self.revisit = revisit
+        self.max_seen = max_seen
+        self.lock = threading.Lock()
+        self.seen = []
+
+    def next(self, state):
+        rng = state["rng"]
+        links = state.get("links")
+        with self.lock:
+            if self.seen and (not links or rng.random() < self.revisit):
+                return None, rng.choice(self.seen)
+        if links:
+            return None, rng.choice(links)
+        return None, "/"
+
+    def visited(self, state, path, status, body):
+        links = []
+        if status == 200:
+            for href in self.LINK.findall(body.decode("utf-8", "replace")):
+                if href.startswith(self.top_url):
+                    links.append(href[len(self.top_url):] or "/")
+        state["links"] = links
+        with self.lock:
+            if len(self.seen) < self.max_seen:
+                self.seen.append(path)
+            else:
+                self.seen[state["rng"].randrange(self.max_seen)] = path
+
+# Spaces requests out so that, between all the clients, no more than
+# rate are sent per second.
+class Pacer:
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            due = max(now, self.next)
+            self.next = due + self.interval
+        if due > now:
+            time.sleep(due - now)
+
+# Nearest rank percentile of a sorted list.
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# Summarise (finish time, latency, status) results and (time, depth)
+# queue samples over some period.
+def summarise(results, depths, seconds):
+    latencies = sorted(latency for _, latency, _ in results)
+    n = len(results)
+    return {
+        "requests": n,
+        "throughput": n / seconds if seconds > 0 else 0,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else 0,
+        "unavailable": sum(1 for _, _, status in results if status == 503) / n if n else 0,
+        "errors": sum(1 for _, _, status in results if status not in (200, 503)),
+        "queue_mean": sum(d for _, d in depths) / len(depths) if depths else 0,
+        "queue_max": max((d for _, d in depths), default=0),
+    }
+
+def report(label, s):
+    print(f"{label:>8} {s['requests']:7d} {s['throughput']:8.1f}/s"
+          f" p50 {s['p50']*1000:7.1f}ms p90 {s['p90']*1000:7.1f}ms p99 {s['p99']*1000:7.1f}ms"
+          f" 503 {s['unavailable']*100:5.1f}% err {s['errors']:4d}"
+          f" queue {s['queue_mean']:5.1f} (max {s['queue_max']})", flush=True)
+
+class LoadTest:
+    def __init__(self, app, source, host, port, concurrency=16, rate=0, max_requests=0, timeout=60):
+        self.app = app
+        self.source = source
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.pacer = Pacer(rate)
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.results = []
+        self.sent = 0
+        self.stop = threading.Event()
+
+    # Send one request, returning its status (0 if it failed) and body.
+    def fetch(self, path):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request("GET", path, headers={"User-Agent": "spigot-loadtest"})
+            response = conn.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            return 0, b""
+        finally:
+            conn.close()
+
+    def client(self, n):
+        state = {"rng": random.Random(n)}
+        while not self.stop.is_set():
+            with self.lock:
+                if self.max_requests and self.sent >= self.max_requests:
+                    break
+                self.sent += 1
+            request = self.source.next(state)
+            if request is None:
+                break
+            due, path = request
+            if due is not None:
+                delay = self.start + due - time.monotonic()
+                if delay > 0 and self.stop.wait(delay):
+                    break
+            else:
+                self.pacer.wait()
+            sent = time.monotonic()
+            status, body = self.fetch(path)
+            done = time.monotonic()
+            self.source.visited(state, path, status, body)
+            with self.lock:
+                self.results.append((done, done - sent, status))
+
+    def run(self, duration=0, interval=5):
+        self.start = time.monotonic()
+        clients = [threading.Thread(target=self.client, args=(n,), daemon=True) for n in range(self.concurrency)]
+        for c in clients:
+            c.start()
+
+        depths = []
+        intervals = []
+        reported_results = reported_depths = 0
+        reported = self.start
+        while any(c.is_alive() for c in clients):
+            time.sleep(0.1)
+            now = time.monotonic()
+            depths.append((now, self.app.loadmanager.waiting()))
+            if duration and now - self.start >= duration:
+                self.stop.set()
+            if now - reported >= interval:
+                with self.lock:
+                    results = self.results[reported_results:]
+                    reported_results = len(self.results)
+                s = summarise(results, depths[reported_depths:], now - reported)
+                s["time"] = now - self.start
+                intervals.append(s)
+                report(f"{s['time']:.0f}s", s)
+                reported_depths = len(depths)
+                reported = now
+        self.stop.set()
+        for c in clients:
+            c.join()
+
+        total = summarise(self.results, depths, time.monotonic() - self.start)
+        report("total", total)
+        return {"intervals": intervals, "total": total}
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test Spigot")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--crawl", action="store_true", help="follow links like a crawler")
+    source.add_argument("--log", help="replay this Apache combined format access log")
+    parser.add_argument("--prefix", default="/", help="path Spigot is served under in the log")
+    parser.add_argument("--speed", type=float, default=0, help="replay the log with its own timing, this many times faster")
+    parser.add_argument("--revisit", type=float, default=0.1, help="chance of the crawler fetching a page it's seen again")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of clients")
+    parser.add_argument("--rate", type=float, default=0, help="requests per second, in total (0 for no limit)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run for (0 for no limit)")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between reports")
+    parser.add_argument("--spigot", default="{}", help="JSON object of extra Spigot arguments")
+    parser.add_argument("--output", help="write results to this JSON file")
+    args = parser.parse_args()
+
+    kwargs = {"home_dir": HOME}
+    kwargs.update(json.loads(args.spigot))
+    app = Spigot(TOP_URL, **kwargs)
+
+    if args.crawl:
+        source = Crawler(TOP_URL, revisit=args.revisit)
+    else:
+        source = LogReplay(args.log, args.prefix, args.speed)
+
+    server = make_server("127.0.0.1", 0, app, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    print(f"Serving on {host}:{port}", file=sys.stderr)
+
+    test = LoadTest(app, source, host, port,
+        concurrency = args.concurrency,
+        rate = args.rate,
+        max_requests = args.requests,
+    )
+    try:
+        results = test.run(args.duration, args.interval)
+    finally:
+        server.shutdown()
+
+    if args.output:
+        output = {
+            "time": int(time.time()),
+            "args": vars(args),
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+if __name__ == "__main__":
+    main()
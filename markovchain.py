@@ -1,28 +1,141 @@
+import hashlib
+import logging
+import mmap
+import os
 import random
 import string
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from itertools import accumulate
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+# A read-only sequence of fixed width strings, packed into one string
+# to avoid the overhead of a Python object per entry. The blob can also
+# be a bytes-like object (e.g. part of a mmap), in which case width is
+# in bytes and each entry is decoded on access.
+class _Packed:
+    def __init__(self, blob, width, encoding=None):
+        self.blob = blob
+        self.width = width
+        self.encoding = encoding
+
+    def __len__(self):
+        return len(self.blob) // self.width
+
+    def __getitem__(self, i):
+        w = self.width
+        if self.encoding is None:
+            return self.blob[i*w:i*w+w]
+        return str(self.blob[i*w:i*w+w], self.encoding)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
 
 class MarkovChain:
-    def __init__(self, filename=None, memory=5):
+    def __init__(self, filename=None, memory=5, compact=False, collapse_runs=False, use_numpy=False, words=False, pace=None):
         self.paraLen = 300
         self.dict = {}
         self.memory = memory
+        self.compact = compact = compact or collapse_runs or use_numpy
+        self.collapse_runs = collapse_runs
+        self.use_numpy = use_numpy
+        self.words = words
 
         if not isinstance(memory, int) or memory < 1:
             raise Exception("Invalid memory size requested")
+        if use_numpy and np is None:
+            raise Exception("use_numpy needs numpy to be installed")
+        if words and compact:
+            raise Exception("The word chain can't be used with compact, collapse_runs or use_numpy")
 
         # Read the input file and generate the Markov dartboard.
-        prev = ""
         with open(filename, "r", encoding="utf-8") as f:
             seedtext = f.read()
+        self.corpus_hash = self._corpus_hash(filename)
+        self.version = self._version(self.corpus_hash, memory, collapse_runs, use_numpy, words)
+
+        # The default backend is a dict mapping each state to a list of
+        # next states. The compact backend holds the same information in
+        # a few flat arrays, using a fraction of the memory.
+        #
+        # With words, states are instead the last "memory" words (each
+        # including any punctuation after it), joined with spaces, and
+        # each step emits a whole word.
+        #
+        # If pace is given, it's called every so often while scanning
+        # the corpus (which is most of the work), e.g. to sleep so that
+        # a build in the background doesn't hog the CPU.
+        if compact:
+            self.dict = None
+            seen = set()
+            transitions = self._transitions(seedtext, seen)
+            if pace is not None:
+                transitions = self._paced(transitions, pace)
+            self._build_compact(transitions, seen)
+            weights = (
+                (i, s, self.offsets[i+1] - self.offsets[i])
+                for i, s in enumerate(self.states)
+            )
+        else:
+            if words:
+                transitions = self._word_transitions(seedtext, self.dict)
+            else:
+                transitions = self._transitions(seedtext, self.dict)
+            if pace is not None:
+                transitions = self._paced(transitions, pace)
+            for prev, nextprev in transitions:
+                if prev in self.dict:
+                    self.dict[prev].append(nextprev)
+                else:
+                    self.dict[prev] = [nextprev]
+            weights = ((k, k, len(v)) for k, v in self.dict.items())
+
+            # Index the keys in sorted order, for finding the ones
+            # that start with a given prefix.
+            self.keys = list(self.dict)
+            self.order = array("I", sorted(range(len(self.keys)), key=self.keys.__getitem__))
 
-        # By re-adding the first few charaxters to the
-        # end, we can guarantee that generate() will
-        # always have an option for the next char.
-        # and this saves a test in its loop iteration.
-        # So we scan twice and, on the second scan, break
-        # out as soon as we see a "prev" that's already
-        # been seen.
+        # Make the "starters" dartboard. We look for things that
+        # look like the starts of sentences. Rather than repeating
+        # each starter once per occurrence, we keep a running total
+        # of the weights and bisect into it, which picks exactly the
+        # same entry as rng.choice() would from the expanded list.
+        self.starters = []
+        self.starter_weights = array("I")
+        self.starter_total = 0
+        for state, k, n in weights:
+            if n == 0 or not self._is_starter(k):
+                continue
+            self.starter_total += n
+            self.starters.append(state)
+            self.starter_weights.append(self.starter_total)
+        if compact:
+            self.starters = array("I", self.starters)
+        if collapse_runs or use_numpy:
+            self._build_runs()
 
+    # Scan the corpus and yield (prev, nextprev) for each character.
+    # "seen" must contain every prev yielded so far: the dict backend
+    # passes its dict, the compact backend a set.
+    #
+    # By re-adding the first few charaxters to the end, we can guarantee
+    # that generate() will always have an option for the next char.
+    # and this saves a test in its loop iteration. So we scan twice and,
+    # on the second scan, break out as soon as we see a "prev" that's
+    # already been seen.
+    def _transitions(self, seedtext, seen):
+        prev = ""
         skip = False
         for scan in range(2):
             for c in seedtext:
@@ -41,101 +154,616 @@ class MarkovChain:
 
                 if len(prev) == self.memory:
                     nextprev = prev[1:] + c
-                    if prev in self.dict:
-                        self.dict[prev].append(nextprev)
-                    else:
-                        self.dict[prev] = [nextprev]
+                    yield prev, nextprev
                     prev = nextprev
                 else:
                     prev = prev + c
 
                 # Break out ASAP on the second pass
-                if scan==1 and prev in self.dict:
+                if scan==1 and prev in seen:
+                    return
+
+    # Pass items through, calling pace() every "every" of them.
+    @staticmethod
+    def _paced(items, pace, every=50000):
+        for i, item in enumerate(items):
+            if i % every == 0:
+                pace()
+            yield item
+
+    # The word chain's equivalent of _transitions(). The corpus is
+    # cleaned up with the same rules, then split into words, and the
+    # first few words are wrapped around to the end in the same way.
+    def _word_transitions(self, seedtext, seen):
+        cleaned = []
+        skip = False
+        for c in seedtext:
+            if c.isalnum():
+                skip = False
+            elif c.isspace():
+                c = " "
+                skip = False
+            elif skip:
+                continue
+            elif c in string.punctuation:
+                skip = True
+            else:
+                skip = True
+                c = " "
+            cleaned.append(c)
+        tokens = "".join(cleaned).split()
+        del cleaned
+
+        n = len(tokens)
+        if n <= self.memory:
+            raise Exception("Not enough words in the corpus")
+        window = tokens[:self.memory]
+        prev = " ".join(window)
+        for i in range(self.memory, 2*n):
+            # Break out ASAP once we've wrapped around
+            if i >= n and prev in seen:
+                return
+            window = window[1:] + [tokens[i % n]]
+            nextprev = " ".join(window)
+            yield prev, nextprev
+            prev = nextprev
+
+    # Build the compact backend. Each distinct state gets an integer id,
+    # in the order it was first seen (which matches the insertion order
+    # of self.dict in the default backend). Successors are held CSR style:
+    # the successors of state i are successors[offsets[i]:offsets[i+1]],
+    # in corpus order, so that picking an index into that range gives the
+    # same answer as rng.choice() on the equivalent list of strings.
+    def _build_compact(self, transitions, seen):
+        index = {}
+        states = []
+        src = array("I")
+        dst = array("I")
+        prev_id = None
+        for prev, nextprev in transitions:
+            seen.add(prev)
+            if prev_id is None:
+                prev_id = index.setdefault(prev, len(index))
+                if prev_id == len(states):
+                    states.append(prev)
+            next_id = index.get(nextprev)
+            if next_id is None:
+                next_id = index[nextprev] = len(states)
+                states.append(nextprev)
+            src.append(prev_id)
+            dst.append(next_id)
+            prev_id = next_id
+        del index, seen
+
+        # A stable sort on the source id keeps each state's successors
+        # in corpus order.
+        counts = Counter(src)
+        self.offsets = array("I", [0])
+        self.offsets.extend(accumulate(counts.get(i, 0) for i in range(len(states))))
+        self.successors = array("I", map(dst.__getitem__, sorted(range(len(src)), key=src.__getitem__)))
+        del src, dst, counts
+
+        # Every state is exactly self.memory characters long, so they
+        # pack into one string. The character emitted when moving into a
+        # state is its last one.
+        blob = "".join(states)
+        self.states = _Packed(blob, self.memory)
+        self.chars = blob[self.memory-1::self.memory]
+
+        # States in sorted order, for looking them up by text or
+        # prefix.
+        self.order = array("I", sorted(range(len(states)), key=states.__getitem__))
+
+    # Precompute deterministic runs. A state is "forced" if all its
+    # successors are the same state, so moving on from it needs no random
+    # choice. For each state, jump[s] is where following forced moves
+    # from s leads, and jump_len[s] the number of characters emitted
+    # along the way (zero if s itself isn't forced). A run stops after
+    # a "." so that generate() still sees every sentence end, and after
+    # self.memory characters, so that the emitted text is always the
+    # tail of the state the run ends in.
+    def _build_runs(self):
+        n = len(self.states)
+        offsets = self.offsets
+        successors = self.successors
+        chars = self.chars
+        none = 0xffffffff
+
+        forced = array("I", [none]) * n
+        for s in range(n):
+            lo, hi = offsets[s], offsets[s+1]
+            if hi > lo:
+                t = successors[lo]
+                if successors[hi-1] == t and all(successors[i] == t for i in range(lo+1, hi-1)):
+                    forced[s] = t
+
+        self.jump = array("I")
+        self.jump_len = bytearray()
+        limit = min(self.memory, 255)
+        for s in range(n):
+            t = s
+            runlen = 0
+            while runlen < limit:
+                u = forced[t]
+                if u == none:
+                    break
+                t = u
+                runlen += 1
+                if chars[t] == ".":
                     break
+            self.jump.append(t)
+            self.jump_len.append(runlen)
 
-        # Make the "starters" dartboard. We look for things that
-        # look like the starts of sentences, and we make a dartboard
-        # out of it.
-        self.starters = []
-        if self.memory == 1:
-            # Have to handle the 1 character memory option separately.
-            for k, v in self.dict.items():
-                if k.isalpha() and k == k.upper():
-                    self.starters += [k] * len(v)
+        # The text of a run is the tail of the state it ends in.
+        if self.states.encoding is None:
+            self.run_text = self.states.blob
         else:
-            # Multi-character memory allows more subtle checking.
-            for k, v in self.dict.items():
-                if k[0].isalpha() and k[0] == k[0].upper() and k[1].isalpha() and k[1] == k[1].lower():
-                    self.starters += [k] * len(v)
-                elif k[0] == "I" and k[1] in (" '"):
-                    self.starters += [k] * len(v)
-                elif k[0:1] == "A ":
-                    self.starters += [k] * len(v)
+            self.run_text = str(self.states.blob, self.states.encoding)
 
-    # The Python random number generator isn't thread-safe. This makes
-    # things complicated in a Flask app, where we want to see the random
-    # number generator. So the generate() method now has a "rng" variable,
-    # which, if supplied can be a thread-local instance of random.Random().
-    def generate(self, numchars, seed_text=None, rng=random):
+    # Find the id of a state from its text, or None if there's no such
+    # state or it has no successors.
+    def _lookup(self, text):
+        i = bisect_left(self.order, text, key=self.states.__getitem__)
+        if i < len(self.order):
+            state = self.order[i]
+            if self.states[state] == text and self.offsets[state] != self.offsets[state+1]:
+                return state
+        return None
+
+    # Return all the states (with successors) whose text starts with
+    # prefix, in the order self.dict would list them. self.order holds
+    # the states sorted by text, so the matches are a contiguous range
+    # of it: from the prefix itself up to the prefix followed by the
+    # highest possible character (which the corpus clean up never lets
+    # into a state). Sorting the matching ids puts them back into
+    # first-seen order, so rng.choice() picks the same state that a scan
+    # of the whole dict would have.
+    def _prefixed(self, prefix):
+        keys = self.states if self.compact else self.keys
+        key = keys.__getitem__
+        lo = bisect_left(self.order, prefix, key=key)
+        hi = bisect_right(self.order, prefix + "\U0010ffff", lo, key=key)
+        possibles = sorted(self.order[lo:hi])
+        if self.compact:
+            offsets = self.offsets
+            return [i for i in possibles if offsets[i] != offsets[i+1]]
+        return [keys[i] for i in possibles]
+
+    # Identify the corpus and model that text is being generated from.
+    @staticmethod
+    def _corpus_hash(filename):
+        with open(filename, "rb") as f:
+            return hashlib.sha256(f.read()).digest()
+
+    @staticmethod
+    def _version(corpus_hash, memory, collapse_runs=False, use_numpy=False, words=False):
+        version = f"{corpus_hash.hex()[:16]}-{memory}"
+        if words:
+            return version + "-words"
+        if use_numpy:
+            return version + "-numpy"
+        if collapse_runs:
+            return version + "-runs"
+        return version
+
+    # Snapshot file layout: a header, then offsets, successors, order,
+    # starters, starter_weights and jump as native uint32 arrays, then
+    # jump_len as bytes, then the packed states (one or four bytes per
+    # character). The run tables are always included, so the same
+    # snapshot serves with or without collapse_runs.
+    SNAPSHOT_MAGIC = b"SPIGOTMC"
+    SNAPSHOT_VERSION = 2
+    SNAPSHOT_HEADER = struct.Struct("=8sIII32sIIII")
+
+    # Write a compact model to a snapshot file. The file is written
+    # under a temporary name and renamed into place, so that processes
+    # loading it never see a partial file.
+    def save(self, path):
+        if not self.compact:
+            raise Exception("Only compact models can be saved")
+        if not hasattr(self, "jump"):
+            self._build_runs()
+
+        blob = self.states.blob
+        if self.states.encoding is not None:
+            charsize = self.states.width // self.memory
+        else:
+            try:
+                blob = blob.encode("latin-1")
+                charsize = 1
+            except UnicodeEncodeError:
+                blob = blob.encode("utf-32-le")
+                charsize = 4
+
+        header = self.SNAPSHOT_HEADER.pack(
+            self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION, sys.byteorder == "little",
+            self.memory, self.corpus_hash, charsize,
+            len(self.states), len(self.successors), len(self.starters)
+        )
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                for a in (self.offsets, self.successors, self.order, self.starters,
+                          self.starter_weights, self.jump, self.jump_len):
+                    f.write(a)
+                f.write(blob)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    # Return a compact model for the corpus, memory-mapped read-only from
+    # a snapshot so that every process using it shares the same pages and
+    # startup doesn't have to rebuild the chain. If the snapshot is
+    # missing, or was built from a different corpus or memory size, it's
+    # rebuilt first. If it can't be written, the freshly built model is
+    # returned instead, with a warning, since every process will then
+    # be building its own.
+    #
+    # Each process does keep its own copy of the last character of each
+    # state (chars, a byte or four per state). If the corpus isn't all
+    # Latin-1, collapse_runs and use_numpy also need all the state text
+    # decoded (run_text, as big as that part of the snapshot). Latin-1
+    # run text is read from the mapping instead, which makes generation
+    # about 10% slower than with a model built in memory.
+    @classmethod
+    def load(cls, filename, memory=5, snapshot=None, collapse_runs=False, use_numpy=False, pace=None):
+        if snapshot is None:
+            snapshot = f"{filename}.m{memory}.snap"
+        corpus_hash = cls._corpus_hash(filename)
+        if use_numpy and np is None:
+            raise Exception("use_numpy needs numpy to be installed")
+
+        try:
+            return cls._map(snapshot, memory, corpus_hash, collapse_runs, use_numpy)
+        except (OSError, ValueError):
+            pass
+
+        mc = cls(filename, memory, compact=True, collapse_runs=collapse_runs, use_numpy=use_numpy, pace=pace)
+        try:
+            mc.save(snapshot)
+            return cls._map(snapshot, memory, mc.corpus_hash, collapse_runs, use_numpy)
+        except (OSError, ValueError) as e:
+            log.warning(f"Couldn't use snapshot {snapshot} ({e}), so the model is held in memory")
+            return mc
+
+    @classmethod
+    def _map(cls, snapshot, memory, corpus_hash, collapse_runs=False, use_numpy=False):
+        with open(snapshot, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = cls.SNAPSHOT_HEADER
+        if len(mm) < header.size:
+            raise ValueError("Snapshot is truncated")
+        magic, version, little, mem, chash, charsize, nstates, nsucc, nstarters = header.unpack_from(mm)
+        if (magic, version, little, mem, chash) != (
+                cls.SNAPSHOT_MAGIC, cls.SNAPSHOT_VERSION, sys.byteorder == "little",
+                memory, corpus_hash):
+            raise ValueError("Snapshot is stale")
+
+        sizes = (nstates + 1, nsucc, nstates, nstarters, nstarters, nstates)
+        if len(mm) != header.size + 4*sum(sizes) + nstates + nstates*memory*charsize:
+            raise ValueError("Snapshot is truncated")
+
+        mv = memoryview(mm)
+        pos = header.size
+        arrays = []
+        for n in sizes:
+            arrays.append(mv[pos:pos+4*n].cast("I"))
+            pos += 4*n
+        arrays.append(mv[pos:pos+nstates])
+        pos += nstates
+        blob = mv[pos:]
+        encoding = "latin-1" if charsize == 1 else "utf-32-le"
+
+        self = cls.__new__(cls)
+        self.paraLen = 300
+        self.dict = None
+        self.memory = memory
+        self.compact = True
+        self.collapse_runs = collapse_runs
+        self.use_numpy = use_numpy
+        self.words = False
+        self.corpus_hash = corpus_hash
+        self.version = cls._version(corpus_hash, memory, collapse_runs, use_numpy)
+        (self.offsets, self.successors, self.order, self.starters,
+            self.starter_weights, self.jump, self.jump_len) = arrays
+        self.starter_total = self.starter_weights[-1] if nstarters else 0
+        self.states = _Packed(blob, memory*charsize, encoding)
+        self.chars = str(blob[(memory-1)*charsize:], encoding)[::memory] if nstates else ""
+        if collapse_runs or use_numpy:
+            # Single byte text is sliced from the mapping as it's needed,
+            # so processes share it; otherwise it's decoded once, here.
+            self.run_text = blob if charsize == 1 else str(blob, encoding)
+        self._mmap = mm
+        return self
+
+    # Does this state look like the start of a sentence?
+    def _is_starter(self, k):
+        if len(k) == 1:
+            # Have to handle the 1 character memory option separately.
+            return k.isalpha() and k == k.upper()
+
+        # Multi-character memory allows more subtle checking.
+        if k[0].isalpha() and k[0] == k[0].upper() and k[1].isalpha() and k[1] == k[1].lower():
+            return True
+        elif k[0] == "I" and k[1] in (" '"):
+            return True
+        elif k[0:1] == "A ":
+            return True
+        return False
+
+    # Pick a random sentence starter.
+    def _starter(self, rng):
+        n = rng.choice(range(self.starter_total))
+        return self.starters[bisect_right(self.starter_weights, n)]
+
+    # Map a state to its text.
+    def _text(self, state):
+        return self.states[state] if self.compact else state
+
+    # Find the state to start generating from, along with the text
+    # that's been "generated" to get there.
+    def _start(self, seed_text, rng):
         text = []
 
         if seed_text is None:
-            prev = rng.choice(self.starters)
-            text.append(prev)
+            prev = self._starter(rng)
+            text.append(self._text(prev))
         else:
             seed_len = len(seed_text)
             text.append(seed_text)
-            if seed_len >= self.memory:
-                prev = seed_text[-self.memory:]
+            if self.words and len(seed_text.split()) >= self.memory:
+                # Carry on from the seed's last few words.
+                prev = " ".join(seed_text.split()[-self.memory:])
                 if prev not in self.dict:
-                    prev = rng.choice(self.starters)
-                    text.append(" " + prev)
+                    prev = self._starter(rng)
+                    text.append(" " + self._text(prev))
+            elif not self.words and seed_len >= self.memory:
+                prev = seed_text[-self.memory:]
+                if self.compact:
+                    prev = self._lookup(prev)
+                elif prev not in self.dict:
+                    prev = None
+                if prev is None:
+                    prev = self._starter(rng)
+                    text.append(" " + self._text(prev))
             else:
-                # Expensive
-                possibles = [s for s in self.dict.keys() if s[0:seed_len] == seed_text]
+                possibles = self._prefixed(seed_text)
                 if len(possibles) == 0:
-                    prev = rng.choice(self.starters)
-                    text.append(" " + prev)
+                    prev = self._starter(rng)
+                    text.append(" " + self._text(prev))
                 else:
                     prev = rng.choice(possibles)
-                    text.append(prev[seed_len:])
+                    text.append(self._text(prev)[seed_len:])
 
-        choices = {}
+        return text, prev
 
-        paragraphs = []
-        length = 0
+    # Walk the chain from prev, yielding one sentence (up to and including
+    # the next ".") at a time. If stops is given, a piece is yielded after
+    # any of the characters in it, instead of just after ".".
+    def _walk_dict(self, prev, rng, stops="."):
+        d = self.dict
+        choice = rng.choice
+        text = []
+        while True:
+            prev = choice(d[prev])
+            c = prev[-1]
+            text.append(c)
+            if c in stops:
+                yield "".join(text)
+                text = []
+
+    # As above, for the word chain. Each step emits a space and a word.
+    # Words always end at a word boundary, so if stops includes a space,
+    # each word is yielded as it's generated.
+    def _walk_words(self, prev, rng, stops="."):
+        d = self.dict
+        choice = rng.choice
+        every = " " in stops
+        text = []
+        while True:
+            prev = choice(d[prev])
+            word = prev.rpartition(" ")[2]
+            text.append(" " + word)
+            if every or word[-1] == ".":
+                yield "".join(text)
+                text = []
 
+    # As above, for the compact backend.
+    def _walk_compact(self, prev, rng, stops="."):
+        successors = self.successors
+        offsets = self.offsets
+        chars = self.chars
+        choice = rng.choice
+        text = []
         while True:
-            nextprev = rng.choice(self.dict[prev])
-            c = nextprev[-1]
+            prev = successors[choice(range(offsets[prev], offsets[prev+1]))]
+            c = chars[prev]
             text.append(c)
-            if c == ".":
-                if numchars == 0:
-                    # numchars = 0 means return one sentence.
-                    paragraphs.append(text)
-                    break
-                else:
-                    plen = len(text)
-                    if plen > self.paraLen:
-                        paragraphs.append(text)
-                        length += plen
+            if c in stops:
+                yield "".join(text)
+                text = []
+
+    # As above, emitting whole deterministic runs at a time and only
+    # consulting rng where there's a real choice to be made, using the
+    # cheaper rng.random() rather than rng.choice(). This consumes
+    # random numbers differently to the other walks, so the text differs
+    # from theirs for the same rng (but is still repeatable). A run is
+    # only split at its last character, so with stops, pieces may run on
+    # past a stop character.
+    def _walk_runs(self, prev, rng, stops="."):
+        successors = self.successors
+        offsets = self.offsets
+        chars = self.chars
+        jump = self.jump
+        jump_len = self.jump_len
+        blob = self.run_text
+        mapped = not isinstance(blob, str)
+        width = self.memory
+        rand = rng.random
+        text = []
+        while True:
+            n = jump_len[prev]
+            if n:
+                prev = jump[prev]
+                end = (prev+1) * width
+                c = blob[end-n:end]
+                if mapped:
+                    c = str(c, "latin-1")
+                text.append(c)
+                c = c[-1]
+            else:
+                lo = offsets[prev]
+                prev = successors[lo + int(rand() * (offsets[prev+1] - lo))]
+                c = chars[prev]
+                text.append(c)
+            if c in stops:
+                yield "".join(text)
+                text = []
 
-                        # numchars > 0 means return paragraphs until
-                        # numchars is exceeded.
-                        if length > numchars:
-                            break
+    # As above, but drawing uniform random numbers from a NumPy generator
+    # in blocks, rather than calling rng.random() for each choice. The
+    # generator is rng.generator if it has one (see rng() below), so a
+    # whole page uses one. Otherwise one's seeded from rng for this
+    # walk, so the text is still the same each time for a given rng
+    # state. Either way, it differs from the other walks'. The blocks
+    # start small, as a title only needs a few numbers, and double up
+    # to NUMPY_BLOCK. Each state's successors, in offsets/successors,
+    # act as its table of cumulative weights (each entry weighing one),
+    # so a uniform draw maps straight to an entry.
+    NUMPY_BLOCK = 512
 
+    def _walk_numpy(self, prev, rng, stops="."):
+        successors = self.successors
+        offsets = self.offsets
+        chars = self.chars
+        jump = self.jump
+        jump_len = self.jump_len
+        blob = self.run_text
+        mapped = not isinstance(blob, str)
+        width = self.memory
+        generator = getattr(rng, "generator", None)
+        if generator is None:
+            generator = np.random.default_rng(rng.getrandbits(64))
+        size = 64
+        text = []
+        while True:
+            for u in generator.random(size).tolist():
+                n = jump_len[prev]
+                while n:
+                    prev = jump[prev]
+                    end = (prev+1) * width
+                    c = blob[end-n:end]
+                    if mapped:
+                        c = str(c, "latin-1")
+                    text.append(c)
+                    if c[-1] in stops:
+                        yield "".join(text)
                         text = []
-            prev = nextprev
+                    n = jump_len[prev]
+                lo = offsets[prev]
+                prev = successors[lo + int(u * (offsets[prev+1] - lo))]
+                c = chars[prev]
+                text.append(c)
+                if c in stops:
+                    yield "".join(text)
+                    text = []
+            size = min(size*2, self.NUMPY_BLOCK)
 
-        # Make each paragraph array into a string.
-        paragraphs = [ "".join(p) for p in paragraphs ]
+    # Return a random.Random() seeded with seed, for generating text
+    # from this model. In numpy mode, it also carries a NumPy generator,
+    # seeded with the same seed, as rng.generator, which every walk
+    # using this rng takes its numbers from. Its state isn't part of
+    # rng.getstate(), so an rng restored from that walks as one made
+    # with random.Random() does.
+    def rng(self, seed=None):
+        rng = random.Random(seed)
+        if self.use_numpy:
+            rng.generator = np.random.default_rng(seed)
+        return rng
 
+    # The Python random number generator isn't thread-safe. This makes
+    # things complicated in a Flask app, where we want to see the random
+    # number generator. So the generate() method now has a "rng" variable,
+    # which, if supplied can be a thread-local instance of random.Random().
+    def generate(self, numchars, seed_text=None, rng=random):
         if numchars == 0:
-            return paragraphs[0]
-        return paragraphs
+            return next(self.paragraphs(0, seed_text, rng))
+        return list(self.paragraphs(numchars, seed_text, rng))
+
+    # The walk for this model's backend.
+    def _walk(self):
+        if self.use_numpy:
+            return self._walk_numpy
+        elif self.collapse_runs:
+            return self._walk_runs
+        elif self.compact:
+            return self._walk_compact
+        elif self.words:
+            return self._walk_words
+        return self._walk_dict
+
+    # Generate one sentence, the same as generate(0), but yielding it a
+    # piece at a time, each ending at the end of a word, so that the
+    # caller can stop once it has enough words. The last piece ends with
+    # ".". The text up to wherever the caller stops is the same as
+    # generate(0) would have given for the same rng.
+    def sentence(self, seed_text=None, rng=random):
+        text, prev = self._start(seed_text, rng)
+        for piece in self._walk()(prev, rng, " ."):
+            if text:
+                text.append(piece)
+                piece = "".join(text)
+                text = None
+            yield piece
+            if piece[-1] == ".":
+                return
+
+    # The same as generate(), but yielding each paragraph as soon as
+    # it's been generated.
+    def paragraphs(self, numchars, seed_text=None, rng=random):
+        text, prev = self._start(seed_text, rng)
+        walk = self._walk()
+
+        length = 0
+
+        # plen counts the seed pieces as one each, then one per character.
+        plen = len(text)
+        for sentence in walk(prev, rng):
+            text.append(sentence)
+            plen += len(sentence)
+            if numchars == 0:
+                # numchars = 0 means return one sentence.
+                yield "".join(text)
+                return
+            if plen > self.paraLen:
+                yield "".join(text)
+                length += plen
+
+                # numchars > 0 means return paragraphs until
+                # numchars is exceeded.
+                if length > numchars:
+                    return
+
+                text = []
+                plen = 0
 
 if __name__ == "__main__":
+    # "python3 markovchain.py build [memory [corpus]]" (re)builds the
+    # snapshot used by MarkovChain.load().
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        memory = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+        corpus = sys.argv[3] if len(sys.argv) > 3 else "markov_input.txt"
+        mc = MarkovChain.load(corpus, memory)
+        if not hasattr(mc, "_mmap"):
+            print(f"Failed to write snapshot for {corpus}")
+            sys.exit(1)
+        print(f"Snapshot for {corpus}, memory={memory} is up to date, version {mc.version}")
+        sys.exit(0)
+
     # Benchmark with the following details.
     seconds = 5
     memory = 8
@@ -144,18 +772,19 @@ if __name__ == "__main__":
     textseed = "Sherlock"
 
     import time
-    random.seed(rndseed)
-    mc = MarkovChain("markov_input.txt", memory=memory)
-    print(f"Benchmarking memory={memory}, length={length} for {seconds} seconds")
-    n = 0
-    chars = 0
-    start = time.time()
-    while True:
-        page = mc.generate(length, textseed)
-        n += 1
-        end = time.time()
-        if end - start >= seconds:
-            break
-    print(page[0])
-    seconds = end-start
-    print(f"\n{n/seconds:.2f} texts per second, ~{n*length/seconds:.0f} chars per second")
+    for collapse_runs in (False, True):
+        random.seed(rndseed)
+        mc = MarkovChain("markov_input.txt", memory=memory, collapse_runs=collapse_runs)
+        print(f"Benchmarking memory={memory}, length={length}, collapse_runs={collapse_runs} for {seconds} seconds")
+        n = 0
+        chars = 0
+        start = time.time()
+        while True:
+            page = mc.generate(length, textseed)
+            n += 1
+            end = time.time()
+            if end - start >= seconds:
+                break
+        print(page[0])
+        elapsed = end-start
+        print(f"\n{n/elapsed:.2f} texts per second, ~{n*length/elapsed:.0f} chars per second\n")
@@ -0,0 +1,76 @@
+# Usage:
+#
+# cache = PageCache(max_bytes = 50*1024*1024)
+#
+# content = cache.get(key)
+# if content is None:
+#   content = make_some_content()
+#   cache.put(key, content, expires = time.time() + 3600)
+#
+# A thread-safe, least recently used cache of generated content, limited
+# to a total size in bytes (counted as the length of each value). Each
+# entry has an absolute expiry time, after which get() treats it as
+# missing. Counts of hits, misses, evictions and expiries are kept for
+# monitoring; see stats().
+#
+import threading
+import time
+from collections import OrderedDict
+
+class PageCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expiries = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires = entry
+            if time.time() >= expires:
+                del self.entries[key]
+                self.size -= size
+                self.expiries += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, expires):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size, expires)
+            self.size += size
+
+            # Throw away least recently used entries until we're
+            # back under budget.
+            while self.size > self.max_bytes:
+                _, (_, oldsize, _) = self.entries.popitem(last=False)
+                self.size -= oldsize
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries":   len(self.entries),
+                "bytes":     self.size,
+                "max_bytes": self.max_bytes,
+                "hits":      self.hits,
+                "misses":    self.misses,
+                "evictions": self.evictions,
+                "expiries":  self.expiries,
+            }
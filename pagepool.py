@@ -0,0 +1,42 @@
+# Usage:
+#
+# pool = PagePool(max_pages = 2000)
+#
+# # Whenever a page is generated:
+# pool.add(content)
+#
+# # When there aren't the resources to generate one:
+# content = pool.random()
+#
+# A fixed size pool of recently generated pages, for serving when we're
+# out of resources. Once the pool is full, each new page replaces the
+# oldest one. random() returns None if the pool is empty.
+#
+import random
+import threading
+
+class PagePool:
+    def __init__(self, max_pages):
+        self.max_pages = max_pages
+        self.lock = threading.Lock()
+        self.pages = []
+        self.next = 0
+        self.served = 0
+
+    def add(self, content):
+        with self.lock:
+            if len(self.pages) < self.max_pages:
+                self.pages.append(content)
+            else:
+                self.pages[self.next] = content
+                self.next = (self.next + 1) % self.max_pages
+
+    def random(self):
+        with self.lock:
+            if len(self.pages) == 0:
+                return None
+            self.served += 1
+            return random.choice(self.pages)
+
+    def __len__(self):
+        return len(self.pages)
@@ -0,0 +1,118 @@
+# Usage:
+#
+# store = PageStore("/var/lib/spigot/store")
+#
+# path = store.find(location, key, encoding)    # or None
+# if path is not None:
+#   send_the_file(os.path.join(store.directory, path))
+#
+# A directory of pages rendered in advance by export.py, so that the web
+# server can send them without Python generating anything. Each export
+# goes in its own subdirectory, with pages sharded two levels deep by
+# the MD5 of their location:
+#
+#   manifest.json
+#   <export>/3f/a2/3fa2...c1.html
+#   <export>/3f/a2/3fa2...c1.html.gz      (and .br, if exported)
+#
+# manifest.json names the current export, and its key: the Spigot's
+# etag() for an empty location and the page_cache_days window, which
+# changes along with the model, the templates, the options that change
+# the content, and the window. find() only returns pages if the key
+# matches the one given, so once the window has moved on, pages are
+# generated as usual until the export is refreshed. The manifest is
+# replaced with a rename, and read again when its mtime changes (checked
+# no more than every check_interval seconds).
+#
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from compression import EncodedPage
+
+MANIFEST = "manifest.json"
+SUFFIXES = {None: "", "gzip": ".gz", "br": ".br"}
+
+# The path of a page within an export.
+def shard(location):
+    h = hashlib.md5(location.encode("utf-8")).hexdigest()
+    return f"{h[:2]}/{h[2:4]}/{h}.html"
+
+# Write a page (a string or an EncodedPage) into an export directory.
+def write_page(directory, location, content):
+    path = os.path.join(directory, shard(location))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not isinstance(content, EncodedPage):
+        content = EncodedPage(content, ())
+    for encoding in (None,) + content.encodings:
+        with open(path + SUFFIXES[encoding], "wb") as f:
+            f.write(content.body(encoding))
+
+# Make an export the current one, and remove any older than the one it
+# replaces (which requests may still be reading).
+def publish(store, export, manifest):
+    manifest = dict(manifest, export=export)
+    fd, tmp = tempfile.mkstemp(dir=store)
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.chmod(tmp, 0o644)
+
+    previous = read_manifest(store)
+    os.replace(tmp, os.path.join(store, MANIFEST))
+
+    keep = {export, previous["export"] if previous else None}
+    for name in os.listdir(store):
+        path = os.path.join(store, name)
+        if name not in keep and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+def read_manifest(store):
+    try:
+        with open(os.path.join(store, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class PageStore:
+    def __init__(self, directory, check_interval=10):
+        self.directory = directory
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.manifest = None
+        self.mtime = None
+        self.checked = 0
+
+    # The current manifest, read again if it's changed.
+    def current(self):
+        now = time.monotonic()
+        if now - self.checked < self.check_interval:
+            return self.manifest
+        with self.lock:
+            if now - self.checked >= self.check_interval:
+                try:
+                    mtime = os.stat(os.path.join(self.directory, MANIFEST)).st_mtime
+                except OSError:
+                    mtime = None
+                if mtime != self.mtime:
+                    self.manifest = read_manifest(self.directory) if mtime is not None else None
+                    self.mtime = mtime
+                self.checked = now
+        return self.manifest
+
+    # Find a page in the current export, returning its path relative to
+    # the store directory, or None if it's not there, the export is out
+    # of date (its key isn't key), or it wasn't exported with encoding.
+    def find(self, location, key, encoding=None):
+        manifest = self.current()
+        if manifest is None or manifest["key"] != key:
+            return None
+        if encoding is not None and encoding not in manifest["encodings"]:
+            return None
+        path = f"{manifest['export']}/{shard(location)}{SUFFIXES[encoding]}"
+        if not os.path.exists(os.path.join(self.directory, path)):
+            return None
+        return path
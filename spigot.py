@@ -1,11 +1,67 @@
 import os, random, re, time, hashlib, struct
 import queue
+import signal
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from itertools import chain
 from urllib.parse import quote
-from flask import Flask, request, render_template, abort
+from flask import Flask, Response, request, render_template, abort, send_file, copy_current_request_context
+from werkzeug.exceptions import HTTPException
+from jinja2 import FileSystemBytecodeCache
 
 from markovchain import MarkovChain
-from loadmanager import LoadManager
+from loadmanager import LoadManager, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from pagecache import PageCache
+from pagepool import PagePool
+from pagestore import PageStore
+from metrics import Metrics
+from tracing import Tracer, NULL_SPAN
+from compression import EncodedPage, ENCODINGS
+
+# The body of a streamed response. done() is called exactly once, when
+# the server closes the response, whether or not it was sent in full. It
+# gets a list of the pieces sent if keep was set and the whole page was
+# sent, otherwise None.
+class _Stream:
+    def __init__(self, chunks, done, keep=False):
+        self.chunks = chunks
+        self.done = done
+        self.pieces = [] if keep else None
+        self.complete = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if self.pieces is not None:
+                self.pieces.append(chunk)
+            yield chunk
+        self.complete = True
+
+    def close(self):
+        done, self.done = self.done, None
+        if done is not None:
+            if hasattr(self.chunks, "close"):
+                self.chunks.close()
+            done(self.pieces if self.complete else None)
+
+# With generation_processes set, pages are generated by a pool of worker
+# processes, each of which holds a copy of the Spigot application in
+# _pool_app. With the "fork" start method, workers inherit the parent's
+# application (and its model); otherwise they construct their own from
+# the same arguments.
+_pool_app = None
+
+def _pool_init(app, cls, kwargs):
+    global _pool_app
+    _pool_app = app if app is not None else cls(**kwargs)
+
+def _pool_page(location):
+    start = time.process_time()
+    with _pool_app.app_context():
+        content = _pool_app.page(location)
+    return content, time.process_time() - start
 
 class Spigot(Flask):
     # This class doesn't define the following methods. If you
@@ -28,6 +84,9 @@ class Spigot(Flask):
     # just returning one of those randomly. Should be very quick and should
     # continue to generate garbage even under high request rates.
     #
+    # Update: Spigot now does that itself if overload_pool_size is set.
+    # The abort hook is then only called if the pool is still empty.
+    #
     # def abort_hook(self):
     #     return "Please try again later"
 
@@ -41,7 +100,8 @@ class Spigot(Flask):
   
     # The page post-hook is called after page content has been created. This
     # function is passed the generated content. You might use this hook to
-    # maintain access stats.
+    # maintain access stats. It's called in the request's context, even
+    # for streamed pages, where that's after the page has been sent.
     #
     # def page_post_hook(self, content):
     #     self.total_size += len(content)
@@ -52,6 +112,17 @@ class Spigot(Flask):
     # def top_pre_hook(self, jinja_tags, rng):
     #     jinja_tags["extra_stuff"] = 42
 
+    # The priority hook is called before a page is generated, and returns
+    # its priority in the load manager (see the PRIORITY_* constants in
+    # loadmanager.py). You might use this to put clients you know to be
+    # abusive behind everyone else. It's called while handling the
+    # request, except under Tarpit, where there's no Flask request.
+    #
+    # def priority_hook(self):
+    #     if request.remote_addr in self.abusers:
+    #         return PRIORITY_ABUSIVE
+    #     return PRIORITY_NORMAL
+
     def __init__(self,
                 top_url,
                 blog_start_date=None,
@@ -63,17 +134,50 @@ class Spigot(Flask):
                 home_dir=None,
                 markov_input="markov_input.txt",
                 markov_memory_length=8,
+                markov_compact=False,
+                markov_snapshot=False,
+                markov_collapse_runs=False,
+                markov_numpy=False,
+                markov_words=False,
+                markov_reload_interval=0,
+                markov_reload_signal=None,
+                markov_reload_cpu_percent=10,
                 max_thread_queue_len=0,
-                max_cpu_percent=50
+                max_queue_wait=0,
+                max_cpu_percent=50,
+                generation_slots=None,
+                page_cache_bytes=0,
+                page_cache_days=1,
+                overload_pool_size=0,
+                overload_refill_interval=0,
+                overload_cpu_percent=10,
+                stream_pages=False,
+                generation_processes=0,
+                generation_max_jobs=0,
+                generation_start_method="fork",
+                metrics_path=None,
+                template_auto_reload=True,
+                template_cache_dir=None,
+                conditional_get=False,
+                compress_pages=False,
+                short_link_titles=False,
+                trace_sample_rate=0,
+                trace_slow_seconds=None,
+                page_store=None,
+                page_store_send="file",
+                page_store_url=None
             ):
+        # Keep hold of the arguments, for starting worker processes.
+        init_args = {k: v for k, v in locals().items() if k not in ("self", "__class__")}
 
         # Home dir not specified: use directory of current file.
         if home_dir is None:
             home_dir = os.path.dirname(os.path.realpath(__file__))
 
-        # Start date not specified - use 10 years ago.
+        # Start date not specified - use 10 years ago, at the start of
+        # the day, so that it (and so the ETags) only changes daily.
         if blog_start_date is None:
-            blog_start_date = int(time.time() - 10*365*24*60*60)
+            blog_start_date = int(time.time() - 10*365*24*60*60) // 86400 * 86400
 
         # Save the bits we need elsewhere.
         self.top_url = top_url
@@ -85,37 +189,425 @@ class Spigot(Flask):
         self.top_page_seed = top_page_seed
         self.top_page_link_list_target_len = top_page_link_list_target_len
 
+        # If stream_pages is set, pages are sent paragraph by paragraph
+        # as they're generated. See page_stream() for how this changes
+        # the content.
+        self.stream_pages = stream_pages
+
+        # Link titles only need a few words, but normally a whole
+        # sentence is generated for each, which uses up random numbers
+        # the rest of the page depends on. short_link_titles stops once
+        # there are enough words; the titles are the same, but the rest
+        # of each page changes.
+        self.short_link_titles = short_link_titles
+
         # Create the Markov Chain using the specified input
-        # file.
-        self.markov = MarkovChain(
-            f"{home_dir}/{markov_input}", 
-            markov_memory_length
-        )
+        # file. The compact backend generates identical text but
+        # uses much less memory. A snapshot is a compact model saved
+        # to disk and memory-mapped, so startup is quick and all
+        # processes share one copy; markov_snapshot can be True for
+        # the default location (next to the corpus), or a filename
+        # (relative to home_dir, unless it's absolute). It must be
+        # somewhere the server can write to; if not, a warning is logged
+        # and every process builds its own model.
+        #
+        # markov_collapse_runs makes generation several times faster,
+        # but changes the text generated for each URL. markov_numpy
+        # (which needs numpy) is about as fast, and changes the text
+        # too.
+        #
+        # markov_words uses a chain of words rather than characters, so
+        # markov_memory_length is in words (2 or 3 is about right). It
+        # generates text several times faster, reading more like the
+        # corpus, but can't be used with the other options.
+        if markov_words and (markov_snapshot or markov_compact or markov_collapse_runs or markov_numpy):
+            raise Exception("markov_words can't be used with the other markov options")
+        self.markov_input = f"{home_dir}/{markov_input}"
+        self.markov_options = {
+            "memory_length": markov_memory_length,
+            "compact":       markov_compact,
+            "snapshot":      markov_snapshot,
+            "collapse_runs": markov_collapse_runs,
+            "numpy":         markov_numpy,
+            "words":         markov_words,
+        }
+        self.markov_mtime = os.stat(self.markov_input).st_mtime
+        self.markov = self.build_markov()
 
-        # Create the load manager.
+        # The model can be rebuilt while we carry on serving pages, if
+        # the corpus changes (checked every markov_reload_interval
+        # seconds) or on markov_reload_signal (e.g. signal.SIGHUP), or
+        # when reload_markov() is called, if either of those is set. The
+        # rebuild is done by a background thread using no more than
+        # markov_reload_cpu_percent of a CPU, and the new model replaces
+        # the old one in one go: pages already being generated carry on
+        # with the old one. Replace the corpus with a rename, rather than
+        # writing it in place, so it's never read half written.
+        self.markov_reload = threading.Event()
+        self.markov_reload_interval = markov_reload_interval
+        self.markov_reload_cpu_percent = markov_reload_cpu_percent
+
+        # Optionally collect metrics, served in Prometheus format at
+        # metrics_path (e.g. "/_metrics"). These are cheap to keep and
+        # don't involve the load manager's lock.
+        self.metrics = None
+        if metrics_path is not None:
+            m = self.metrics = Metrics("spigot_")
+            self.metric_pages = m.counter("pages_total", "Pages generated")
+            self.metric_bytes = m.counter("page_bytes_total", "Characters of page content generated")
+            self.metric_generation = m.histogram("generation_seconds", "Time taken to generate a page")
+            self.metric_wait = m.histogram("loadmanager_wait_seconds", "Time spent waiting for a generation slot")
+            self.metric_sleep = m.histogram("loadmanager_sleep_seconds", "Time spent sleeping to meet the CPU target")
+            self.metric_overloaded = m.counter("overloaded_total", "Requests that couldn't be given a generation slot")
+            self.metric_unavailable = m.counter("unavailable_total", "Overloaded requests answered with an error")
+            self.metric_hook = m.counter("abort_hook_pages_total", "Overloaded requests answered with a page from abort_hook")
+            self.metric_pool = m.counter("overload_pool_pages_total", "Overloaded requests answered from the overload pool")
+            m.gauge("queue_depth", "Requests waiting for or holding a generation slot", lambda: self.loadmanager.waiting())
+            m.counter("expired_total", "Requests that gave up waiting for a generation slot", lambda: self.loadmanager.expired)
+
+        # Optionally time the phases of generating a page (seeding, the
+        # title, links, text, hooks, rendering, and waiting and sleeping
+        # in the load manager), for trace_sample_rate of the pages
+        # generated. The times are added to per-phase histograms in the
+        # metrics, and pages taking trace_slow_seconds or more are
+        # logged with their phase times. See tracing.py.
+        self.tracer = None
+        if trace_sample_rate > 0:
+            self.tracer = Tracer(trace_sample_rate, trace_slow_seconds, metrics=self.metrics)
+
+        # Create the load manager. generation_slots pages can be
+        # generated at once; max_cpu_percent applies to all of them
+        # together. By default there's one slot, or one per worker
+        # process with generation_processes, since a page generated by
+        # a worker holds a slot until it's done.
+        #
+        # The top page goes ahead of other pages, and refilling the
+        # overload pool goes behind them. A request that's waited more
+        # than max_queue_wait seconds (if set) for a slot is treated as
+        # overloaded, rather than generating a page for a client that's
+        # probably given up on it.
         self.loadmanager = LoadManager(
             max_queue_len = max_thread_queue_len,
-            target_pcpu = max_cpu_percent
+            max_wait = max_queue_wait,
+            target_pcpu = max_cpu_percent,
+            slots = generation_slots or max(1, generation_processes),
+            observe_wait = self.observer("wait", self.metric_wait if self.metrics else None),
+            observe_sleep = self.observer("sleep", self.metric_sleep if self.metrics else None)
         )
 
+        # Optionally cache rendered pages, so that repeat visits to a URL
+        # don't need to go through the load manager at all. Cached pages
+        # expire at the end of each page_cache_days period, so that links
+        # to "recent" pages appear more or less on time.
+        self.pagecache = None
+        self.page_cache_days = page_cache_days
+        if page_cache_bytes > 0:
+            self.pagecache = PageCache(page_cache_bytes)
+            if self.metrics is not None:
+                stats = self.pagecache.stats
+                self.metrics.counter("page_cache_hits_total", "Page cache hits", lambda: stats()["hits"])
+                self.metrics.counter("page_cache_misses_total", "Page cache misses", lambda: stats()["misses"])
+                self.metrics.counter("page_cache_evictions_total", "Page cache evictions", lambda: stats()["evictions"])
+                self.metrics.gauge("page_cache_bytes", "Size of cached pages", lambda: stats()["bytes"])
+
+        # Optionally keep a pool of recently generated pages, one of
+        # which is returned (as a normal page) when there aren't the
+        # resources to generate the one requested. If a refill interval
+        # is given, a background thread also adds a page to the pool
+        # every overload_refill_interval seconds, but only while nothing
+        # is waiting on the load manager, and using no more than
+        # overload_cpu_percent of a CPU.
+        self.overload_pool = None
+        self.overload_refill_interval = overload_refill_interval
+        self.overload_cpu_percent = overload_cpu_percent
+        if overload_pool_size > 0:
+            self.overload_pool = PagePool(overload_pool_size)
+
+        # The top page, and the state needed to update it. See top_router().
+        self.top_cache = None
+        self.top_lock = threading.Lock()
+
         # Start the Flask application.
         super().__init__("server",
             template_folder=f"{home_dir}/templates",
             static_folder=f"{home_dir}/static"
         )
-        self.config["TEMPLATES_AUTO_RELOAD"] = True
+
+        # Slow pages are logged with the application's logger, which
+        # only exists now.
+        if self.tracer is not None:
+            self.tracer.logger = self.logger
+
+        # By default, templates are checked for changes on every request,
+        # which is handy while editing them. In production, set
+        # template_auto_reload=False so they're only loaded once, and
+        # optionally give template_cache_dir (relative to home_dir, unless
+        # it's absolute) to keep compiled templates there, so new processes
+        # needn't compile them again.
+        self.config["TEMPLATES_AUTO_RELOAD"] = template_auto_reload
+        if template_cache_dir is not None:
+            template_cache_dir = os.path.join(home_dir, template_cache_dir)
+            os.makedirs(template_cache_dir, exist_ok=True)
+            self.jinja_options = dict(self.jinja_options,
+                bytecode_cache=FileSystemBytecodeCache(template_cache_dir)
+            )
+
+        # With conditional_get, pages are sent with ETag and Last-Modified
+        # headers, and crawlers coming back with them get a 304 without
+        # anything being generated. A page's ETag changes when the
+        # model, the templates, the options below or the page_cache_days
+        # period do (so pages can be a day or so out of date, as with the
+        # page cache); the top page's changes whenever its content does.
+        # The templates are only checked here, so restart after editing
+        # them.
+        self.conditional_get = conditional_get
+        templates = hashlib.md5()
+        for name in ("index.tpl", "page.tpl"):
+            with open(f"{home_dir}/templates/{name}", "rb") as f:
+                templates.update(f.read())
+        self.template_version = templates.hexdigest()
+
+        # The other options the content of pages depends on.
+        config = [top_url, blog_start_date, min_page_len, max_page_len,
+            top_page_len, top_page_seed, top_page_link_list_target_len]
+        self.config_version = hashlib.md5(repr(config).encode("utf-8")).hexdigest()
+
+        # With compress_pages, each page is compressed (with gzip, and
+        # brotli if it's installed) as soon as it's generated, inside the
+        # load manager so it counts towards the CPU target. The compressed
+        # copies are kept in the page cache and overload pool along with
+        # the text, and sent to clients that accept them.
+        self.page_encodings = ENCODINGS if compress_pages else ()
+
+        # Optionally send pages rendered in advance by export.py from
+        # page_store (relative to home_dir, unless it's absolute), rather
+        # than generating them. page_store_send says how: "file" sends
+        # the file from here (using the server's wsgi.file_wrapper, if
+        # it has one), "x-sendfile" leaves it to Apache's mod_xsendfile,
+        # and "x-accel-redirect" to nginx, which should serve
+        # page_store_url as an internal location aliased to page_store.
+        self.pagestore = None
+        if page_store is not None:
+            if page_store_send not in ("file", "x-sendfile", "x-accel-redirect"):
+                raise Exception(f"Unknown page_store_send {page_store_send}")
+            if page_store_send == "x-accel-redirect" and page_store_url is None:
+                raise Exception("page_store_send x-accel-redirect needs page_store_url")
+            self.pagestore = PageStore(os.path.join(home_dir, page_store))
+            self.page_store_send = page_store_send
+            self.page_store_url = page_store_url
+            if self.metrics is not None:
+                self.metric_stored = self.metrics.counter("page_store_pages_total", "Pages sent from the page store")
 
         # Register URL paths.
         self.add_url_rule("/", view_func=self.top_router, methods=["GET"])
         self.add_url_rule("/<path:location>", view_func=self.page_router, methods=["GET"])
+        if metrics_path is not None:
+            self.add_url_rule(metrics_path, view_func=self.metrics_router, methods=["GET"])
+
+        # Optionally generate pages in a pool of worker processes, to get
+        # around the GIL. Each worker generates one page at a time and
+        # reports the CPU it used to the load manager. No more than
+        # generation_max_jobs pages (by default, one per process) can be
+        # queued for the pool at once, beyond which we're overloaded.
+        # Streamed pages are always generated in-process. The workers'
+        # CPU counts towards max_cpu_percent, so raise that (up to 100
+        # per process) to make use of them; the default of 50 gives them
+        # half a CPU between them.
+        #
+        # The workers are started (and, with "fork", forked) here, before
+        # any requests arrive. Hooks run in the workers, apart from
+        # page_post_hook, which still runs here.
+        #
+        # If the model is reloaded, or a worker dies (e.g. killed for
+        # using too much memory), the pool is replaced with a new one.
+        # generation_lock is held while that's done. See
+        # start_generation_pool() for what that costs.
+        self.generation_pool = None
+        self.generation_lock = threading.Lock()
+        self.generation_processes = generation_processes
+        self.generation_start_method = generation_start_method
+        self.generation_init_args = dict(init_args,
+            generation_processes=0, overload_refill_interval=0,
+            markov_reload_interval=0, markov_reload_signal=None
+        )
+        if generation_processes > 0:
+            self.generation_jobs = threading.BoundedSemaphore(generation_max_jobs or generation_processes)
+            self.generation_pool = self.start_generation_pool()
+
+        if self.overload_pool is not None and overload_refill_interval > 0:
+            threading.Thread(target=self.refill_overload_pool, daemon=True).start()
+
+        if markov_reload_interval > 0 or markov_reload_signal is not None:
+            if markov_reload_signal is not None:
+                signal.signal(markov_reload_signal, lambda signum, frame: self.reload_markov())
+            threading.Thread(target=self.markov_reloader, daemon=True).start()
+
+    # Start the worker processes, returning the pool. With replacement,
+    # the pool is to replace another while requests are being served,
+    # when it isn't safe to fork: any lock a request thread held (in
+    # Jinja, the logging module, the page cache...) would stay locked in
+    # the workers. So "fork" pools are replaced using "forkserver", whose
+    # workers build their own Spigot from the same arguments.
+    #
+    # Rather than each rebuilding the model at full speed, uncharged to
+    # the load manager, those workers map a snapshot (markov_snapshot's,
+    # or the default one, next to the corpus), which is first made here
+    # if it's out of date, at markov_reload_cpu_percent. That doesn't
+    # work for markov_words, or if the snapshot can't be written, in
+    # which case every worker does build its own model.
+    #
+    # Workers are otherwise started as they're needed, so one job is
+    # sent to each, to get them all going before the pool's used.
+    def start_generation_pool(self, replacement=False):
+        start_method = self.generation_start_method
+        if replacement and start_method == "fork":
+            start_method = "forkserver"
+        if start_method == "fork":
+            initargs = (self, None, None)
+        else:
+            kwargs = self.generation_init_args
+            if replacement and not self.markov_options["words"]:
+                snapshot = self.markov_options["snapshot"] or True
+                self.build_markov(pace=self.markov_pacer(), snapshot=snapshot)
+                kwargs = dict(kwargs, markov_snapshot=snapshot)
+            initargs = (None, type(self), kwargs)
+        pool = ProcessPoolExecutor(
+            max_workers = self.generation_processes,
+            mp_context = multiprocessing.get_context(start_method),
+            initializer = _pool_init,
+            initargs = initargs
+        )
+        for future in [pool.submit(int) for _ in range(self.generation_processes)]:
+            future.result()
+        return pool
+
+    # Build a MarkovChain from the corpus, as set up by the constructor's
+    # markov_* arguments. pace is passed on to MarkovChain, and snapshot,
+    # if given, overrides markov_snapshot.
+    def build_markov(self, pace=None, snapshot=None):
+        o = self.markov_options
+        snapshot = snapshot or o["snapshot"]
+        if o["words"]:
+            return MarkovChain(self.markov_input, o["memory_length"], words=True, pace=pace)
+        if snapshot:
+            return MarkovChain.load(
+                self.markov_input,
+                o["memory_length"],
+                None if snapshot is True else os.path.join(self.home_dir, snapshot),
+                collapse_runs=o["collapse_runs"],
+                use_numpy=o["numpy"],
+                pace=pace
+            )
+        return MarkovChain(
+            self.markov_input,
+            o["memory_length"],
+            compact=o["compact"],
+            collapse_runs=o["collapse_runs"],
+            use_numpy=o["numpy"],
+            pace=pace
+        )
+
+    # Ask for the model to be rebuilt from the corpus. This only sets a
+    # flag, so it's safe to call from a signal handler.
+    def reload_markov(self):
+        self.markov_reload.set()
+
+    # Background thread which rebuilds the model when asked to, or when
+    # the corpus has changed, and swaps it in if it's different.
+    def markov_reloader(self):
+        while True:
+            asked = self.markov_reload.wait(self.markov_reload_interval or None)
+            self.markov_reload.clear()
+            try:
+                mtime = os.stat(self.markov_input).st_mtime
+            except OSError:
+                continue
+            if not asked and mtime == self.markov_mtime:
+                continue
+            self.markov_mtime = mtime
+
+            # With a pool to replace, the model's built via a snapshot,
+            # for the new workers to map (see start_generation_pool()).
+            snapshot = None
+            if self.generation_pool is not None:
+                snapshot = self.markov_options["snapshot"] or True
+            try:
+                markov = self.build_markov(pace=self.markov_pacer(), snapshot=snapshot)
+            except Exception:
+                self.logger.exception(f"Failed to rebuild the Markov chain from {self.markov_input}")
+                continue
+            if markov.version == self.markov.version:
+                continue
+
+            # If the new pool can't be started, e.g. because the Spigot
+            # subclass can't be imported, pages are generated here. It's
+            # started before the model's swapped, so the old workers
+            # don't serve pages tagged with the new version.
+            with self.generation_lock:
+                old_pool = pool = self.generation_pool
+                if old_pool is not None:
+                    try:
+                        pool = self.start_generation_pool(replacement=True)
+                    except Exception:
+                        self.logger.exception("Failed to restart the worker processes, so generating pages in-process")
+                        pool = None
+                self.markov = markov
+                self.generation_pool = pool
+            if old_pool is not None:
+                old_pool.shutdown(wait=False)
+            self.logger.info(f"Reloaded the Markov chain from {self.markov_input}, version {markov.version}")
+
+    # Return a function for MarkovChain to call while it's being built,
+    # which sleeps long enough to keep this thread's CPU usage down to
+    # markov_reload_cpu_percent.
+    def markov_pacer(self):
+        last = time.thread_time()
+        def pace():
+            nonlocal last
+            cpu = time.thread_time() - last
+            time.sleep(max(0, cpu*100/self.markov_reload_cpu_percent - cpu))
+            last = time.thread_time()
+        return pace
 
     # Top level page has a predefined title and gets a short
     # article and a long list of links.
+    #
+    # Its content only changes when the roundedtime(90) window does, or
+    # when the next link in the list comes into range, so the rendered
+    # page is kept until then. Rebuilding it is done under the load
+    # manager, by one thread at a time; while that's happening, or if
+    # we're overloaded, other requests get the previous version.
     def top_router(self):
-        # Fixed seed so the content and list of links on the 
-        # page is fixed (more or less).
-        rng = random.Random(self.top_page_seed)
+        encoding = self.negotiate()
+        top = self.top_entry()
+        if top is None:
+            return self.respond(self.overloaded(), encoding)
+        return self.validated(self.respond(top["encoded"], encoding), self.etag_for(top["etag"], encoding), top["modified"])
+
+    # Return self.top_cache, first bringing it up to date if need be, or
+    # None if we're overloaded and there isn't a previous version.
+    def top_entry(self):
+        top = self.top_cache
+        if (top is not None and top["window"] == self.roundedtime(90) and time.time() <= top["next_stamp"]
+                and top["version"] == self.markov.version):
+            return top
 
+        if not self.top_lock.acquire(blocking=(top is None)):
+            return top
+        try:
+            # Another thread may have refreshed it while we waited.
+            if self.top_cache is not top:
+                return self.top_cache
+            with self.loadmanager(priority=PRIORITY_HIGH):
+                self.top_page()
+            return self.top_cache
+        except queue.Full:
+            return top
+        finally:
+            self.top_lock.release()
+
+    # Generate the top page, recording it in self.top_cache.
+    def top_page(self):
         # Make a list of dated links. We step through the date range of the
         # "blog", aiming for approximately the number of links requested.
         #
@@ -123,66 +615,491 @@ class Spigot(Flask):
         # list of links doesn't change constantly. It'll change roughly
         # every 3 months, and will have additions (recent posts) during
         # the 3 month period.
-        link_list = []
         now = time.time()
-        interval = (self.roundedtime(90) - self.blog_start_date) // self.top_page_link_list_target_len
+        window = self.roundedtime(90)
+        interval = (window - self.blog_start_date) // self.top_page_link_list_target_len
+        markov = self.markov
+
+        # Fixed seed so the content and list of links on the 
+        # page is fixed (more or less). If we've already built the list
+        # for this window, pick up where we left off: the random number
+        # generator's state is saved along with the list, so we'll get
+        # the same result as starting from scratch.
+        top = self.top_cache
+        if top is not None and top["window"] == window and top["version"] == markov.version:
+            rng = random.Random()
+            rng.setstate(top["rng_state"])
+            link_list = list(top["link_list"])
+            stamp = top["next_stamp"]
+            modified = top["modified"]
+        else:
+            # Not markov.rng(), as in numpy mode its draws couldn't be
+            # saved along with rng's state.
+            rng = random.Random(self.top_page_seed)
+            link_list = []
+            stamp = self.blog_start_date
+            modified = window
 
-        stamp = self.blog_start_date
         while stamp < now:
-            title, date, url = self.datedlink(stamp, rng=rng)
+            title, date, url = self.datedlink(stamp, rng=rng, markov=markov)
 
             # Add to the list, most recent first.
             link_list.insert(0, [ url, date + ": " + title ])
+            modified = max(modified, stamp)
 
             # Step forward by amount randomly centred on the interval needed
             # to make the list length close to that requested.
             stamp += rng.randint(interval//2, interval*3//2)
+        rng_state = rng.getstate()
 
         # Put in default jinja tags and call the top hook for
-        # extra stuff to be put in, if needed.
+        # extra stuff to be put in, if needed. Note that the hook is
+        # only called when the page is regenerated.
         tags = {
             "top_url":     self.top_url,
-            "markov_text": self.pagetext(rng),
+            "markov_text": self.pagetext(rng, markov),
             "link_list":   link_list,
         }
         if hasattr(self, "top_pre_hook"):
             self.top_pre_hook(tags, rng)
 
         # Finally render the template with the collected info.
-        return render_template("index.tpl", **tags)
+        content = render_template("index.tpl", **tags)
+        self.top_cache = {
+            "version":    markov.version,
+            "window":     window,
+            "next_stamp": stamp,
+            "rng_state":  rng_state,
+            "link_list":  link_list,
+            "content":    content,
+            "encoded":    self.encode(content),
+            "etag":       self.etag("", window, stamp, markov=markov),
+            "modified":   int(modified),
+        }
+        return content
 
     # All other pages get much longer content and next/previous
     # links.
+    #
+    # With conditional_get, a request whose If-None-Match or
+    # If-Modified-Since matches is answered with a 304 straight away.
     def page_router(self, location):
-        # Serialise page generation using LoadManager.
+        markov = self.markov
+        encoding = self.negotiate()
+        window = self.roundedtime(self.page_cache_days)
+        etag = self.etag(location, window, markov=markov)
+        if self.conditional_get:
+            # A streamed page is sent uncompressed, with the plain ETag,
+            # so a client may come back with either.
+            tags = [self.etag_for(etag, encoding)]
+            if self.stream_pages and encoding is not None:
+                tags.append(etag)
+            for tag in tags:
+                if self.not_modified(tag, window):
+                    return self.validated(None, tag, window)
+        if self.pagestore is not None:
+            response, encoding = self.stored_page(location, window, encoding, markov)
+            if response is not None:
+                return self.validated(response, self.etag_for(etag, encoding), window)
         try:
-            with self.loadmanager:
-                content = self.page(location)
-                if hasattr(self, "page_post_hook"):
+            if self.stream_pages:
+                content = self.stream_page(location, markov)
+            else:
+                content = self.serve_page(location, markov)
+        except queue.Full:
+            return self.respond(self.overloaded(), encoding)
+
+        # A page that's streamed as it's generated isn't compressed.
+        if not isinstance(content, Response):
+            etag = self.etag_for(etag, encoding)
+        return self.validated(self.respond(content, encoding), etag, window)
+
+    # A Response sending a page from the page store, and the encoding
+    # it's sent with, or None if the store doesn't have the page for the
+    # current window. If it doesn't have the encoding asked for, the
+    # plain text is sent.
+    def stored_page(self, location, window, encoding, markov=None):
+        key = self.etag("", window, markov=markov)
+        path = self.pagestore.find(location, key, encoding)
+        if path is None and encoding is not None:
+            encoding = None
+            path = self.pagestore.find(location, key)
+        if path is None:
+            return None, encoding
+
+        if self.page_store_send == "x-sendfile":
+            response = Response(mimetype="text/html")
+            response.headers["X-Sendfile"] = os.path.join(self.pagestore.directory, path)
+        elif self.page_store_send == "x-accel-redirect":
+            response = Response(mimetype="text/html")
+            response.headers["X-Accel-Redirect"] = f"{self.page_store_url.rstrip('/')}/{path}"
+        else:
+            response = send_file(os.path.join(self.pagestore.directory, path), mimetype="text/html", etag=False, conditional=False)
+        if encoding is not None:
+            response.content_encoding = encoding
+        if self.page_encodings:
+            response.vary.add("Accept-Encoding")
+        if self.metrics is not None:
+            self.metric_stored.inc()
+        return response, encoding
+
+    # Make an ETag for the content of a location. Pages only depend on
+    # the location, the model, the templates, the options in
+    # config_version and the time, which is taken as the window (and,
+    # for the top page, next_stamp) given. So this doesn't need the page
+    # to have been generated. Subclasses whose hooks add other content
+    # should extend this.
+    def etag(self, location, *times, markov=None):
+        version = (markov or self.markov).version
+        if self.short_link_titles:
+            version += "-short"
+        key = "\0".join([location, version, self.template_version, self.config_version, str(self.stream_pages)] + [str(t) for t in times])
+        return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+    # Each encoding of a page is a different representation, so needs
+    # its own ETag.
+    def etag_for(self, etag, encoding):
+        return etag if encoding is None else f"{etag}-{encoding}"
+
+    # Choose which of page_encodings to send, or None for the plain text.
+    def negotiate(self):
+        if not self.page_encodings or "Accept-Encoding" not in request.headers:
+            return None
+        return request.accept_encodings.best_match(self.page_encodings)
+
+    # Turn newly generated content into what's kept and served: with
+    # compress_pages, an EncodedPage. Call this inside the load manager.
+    def encode(self, content):
+        if not self.page_encodings:
+            return content
+        return EncodedPage(content, self.page_encodings)
+
+    # With compress_pages, make a Response from content (an EncodedPage,
+    # a string or a Response), using the given encoding if it's an
+    # EncodedPage. Without, content is returned as it is.
+    def respond(self, content, encoding):
+        if not self.page_encodings:
+            return content
+        if isinstance(content, EncodedPage):
+            response = Response(content.body(encoding), mimetype="text/html")
+            if encoding is not None:
+                response.content_encoding = encoding
+        elif isinstance(content, Response):
+            response = content
+        else:
+            response = Response(content, mimetype="text/html")
+        response.vary.add("Accept-Encoding")
+        return response
+
+    # Does the request's If-None-Match or, failing that, its
+    # If-Modified-Since, match content with the given ETag and
+    # Last-Modified timestamp?
+    def not_modified(self, etag, modified):
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(etag)
+        if request.if_modified_since is not None:
+            return modified <= request.if_modified_since.timestamp()
+        return False
+
+    # If conditional_get is set, turn content (a string or Response)
+    # into a Response with ETag and Last-Modified headers, or a 304 if
+    # the request's conditions match or content is None.
+    def validated(self, content, etag, modified):
+        if not self.conditional_get:
+            return content
+        if content is None or self.not_modified(etag, modified):
+            response = Response(status=304)
+            if self.page_encodings:
+                response.vary.add("Accept-Encoding")
+        elif isinstance(content, Response):
+            response = content
+        else:
+            response = Response(content, mimetype="text/html")
+        response.set_etag(etag)
+        response.last_modified = modified
+        return response
+
+    # Return the content for a page, from the cache if possible.
+    # Otherwise page generation is serialised using LoadManager,
+    # which raises queue.Full if there are too many waiting.
+    def serve_page(self, location, markov=None):
+        markov = markov or self.markov
+        key = self.cache_key(location, markov)
+        if self.pagecache is not None:
+            content = self.pagecache.get(key)
+            if content is not None:
+                return content
+
+        with self.trace(location, markov), self.loadmanager(priority=self.priority()):
+            content = self.generate_page(location, markov)
+            if hasattr(self, "page_post_hook"):
+                with self.span("page_post_hook"):
                     self.page_post_hook(content)
+            with self.span("encode"):
+                content = self.encode(content)
+
+        if self.pagecache is not None:
+            expires = self.roundedtime(self.page_cache_days) + self.page_cache_days*86400
+            self.pagecache.put(key, content, expires)
+        if self.overload_pool is not None:
+            self.overload_pool.add(content)
+        return content
+
+    # Trace the phases of generating a page, if tracing is on.
+    def trace(self, location, markov=None):
+        if self.tracer is None:
+            return NULL_SPAN
+        return self.tracer.trace(location, (markov or self.markov).version)
+
+    # Time a phase of the page being traced, if any.
+    def span(self, name):
+        if self.tracer is None:
+            return NULL_SPAN
+        return self.tracer.span(name)
+
+    # A load manager observe_wait or observe_sleep function, adding to
+    # the histogram (if given) and to the page being traced (if any).
+    def observer(self, phase, histogram=None):
+        if self.tracer is None:
+            return histogram.observe if histogram is not None else None
+        def observe(seconds):
+            if histogram is not None:
+                histogram.observe(seconds)
+            self.tracer.record(phase, seconds)
+        return observe
+
+    # The load manager priority for the page being requested.
+    def priority(self):
+        if hasattr(self, "priority_hook"):
+            return self.priority_hook()
+        return PRIORITY_NORMAL
+
+    # The page cache key for a location. Pages from different models
+    # are kept apart, so that once a new model is loaded, pages from the
+    # old one aren't served again.
+    def cache_key(self, location, markov=None):
+        return f"{(markov or self.markov).version}/{location}"
+
+    # Generate a page, either here or in the worker processes. Call this
+    # inside the load manager.
+    def generate_page(self, location, markov=None):
+        if self.metrics is not None:
+            start = time.monotonic()
+            content = self._generate_page(location, markov)
+            self.metric_generation.observe(time.monotonic() - start)
+            self.metric_pages.inc()
+            self.metric_bytes.inc(len(content))
             return content
-        except queue.Full:
-            if hasattr(self, "abort_hook"):
-                # abort_hook can now return either a string or 
-                # a http code and a string. In the latter case,
-                # if the code is 200 then a normal return is
-                # done with the content, else the code is passed
-                # to abort along with the content.
-                hook_output = self.abort_hook()
-                if isinstance(hook_output, str):
-                    abort(503, hook_output)
-                elif isinstance(hook_output, tuple) or isinstance(hook_output, list):
-                    code, content = hook_output
-                    if code != 200:
-                        abort(code, content)
-                    else:
-                        return content
+        return self._generate_page(location, markov)
+
+    # The rest of generate_page(), without the metrics. The worker
+    # processes use their own copy of the model. If the pool's broken,
+    # or has just been replaced, the page is generated here instead.
+    def _generate_page(self, location, markov=None):
+        pool = self.generation_pool
+        if pool is None:
+            return self.page(location, markov)
+
+        if not self.generation_jobs.acquire(blocking=False):
+            raise queue.Full
+        content = None
+        try:
+            with self.span("pool"):
+                content, cpu = pool.submit(_pool_page, location).result()
+        except BrokenProcessPool:
+            self.logger.exception("A worker process died, so restarting the worker processes")
+            self.restart_generation_pool(pool)
+        except RuntimeError:
+            # Either the pool was shut down, having been replaced, or
+            # this came from generating the page.
+            if self.generation_pool is pool:
+                raise
+        finally:
+            self.generation_jobs.release()
+        if content is None:
+            return self.page(location, markov)
+        self.loadmanager.charge(cpu)
+        return content
+
+    # Replace a broken worker pool, in the background. Until the new
+    # one's ready, pages are generated in-process.
+    def restart_generation_pool(self, broken):
+        with self.generation_lock:
+            if self.generation_pool is not broken:
+                return
+            self.generation_pool = None
+        broken.shutdown(wait=False)
+        threading.Thread(target=self.generation_restarter, daemon=True).start()
+
+    # Background thread which starts the pool restart_generation_pool()
+    # dropped. If the model's been reloaded meanwhile, the reloader will
+    # have left the pool alone, and the workers build the new model.
+    def generation_restarter(self):
+        with self.generation_lock:
+            if self.generation_pool is not None:
+                return
+            try:
+                self.generation_pool = self.start_generation_pool(replacement=True)
+            except Exception:
+                self.logger.exception("Failed to restart the worker processes, so generating pages in-process")
+                return
+        self.logger.info("Restarted the worker processes")
+
+    # The streamed equivalent of serve_page(), returning a Response.
+    # The load manager is entered here to start the page, so that we can
+    # still give up if there are too many waiting, and again for each
+    # paragraph (see metered()), so a slot isn't held while a slow
+    # client reads the page. Pages are only kept (for the hook, cache
+    # and overload pool) if they were sent in full.
+    #
+    # Everything after the first piece happens once the view has
+    # returned and Flask has popped its contexts. The later paragraphs
+    # are generated in an application context, so targetlength() and
+    # linkparagraph() can use current_app, but not request. done(),
+    # which calls page_post_hook, runs in a copy of the request's
+    # context, so the hook sees the same request, g and current_app as
+    # it would for a page that isn't streamed.
+    def stream_page(self, location, markov=None):
+        markov = markov or self.markov
+        key = self.cache_key(location, markov)
+        if self.pagecache is not None:
+            content = self.pagecache.get(key)
+            if content is not None:
+                return content
+
+        # Tracing covers sending the page too, as "stream".
+        if self.tracer is not None:
+            self.tracer.begin(location, markov.version)
+        start = time.monotonic()
+        try:
+            with self.loadmanager(priority=self.priority()):
+                chunks = self.page_stream(location, markov)
+                head = next(chunks)
+        except BaseException:
+            if self.tracer is not None:
+                self.tracer.end(discard=True)
+            raise
+        chunks = chain([head], self.metered(chunks))
+
+        keep = hasattr(self, "page_post_hook") or self.pagecache is not None or self.overload_pool is not None or self.metrics is not None
+        def done(pieces):
+            if self.tracer is not None:
+                self.tracer.record("stream", time.monotonic() - start)
+            content = None if pieces is None else "".join(pieces)
+            if content is not None and self.metrics is not None:
+                # This includes the time spent sending the page.
+                self.metric_generation.observe(time.monotonic() - start)
+                self.metric_pages.inc()
+                self.metric_bytes.inc(len(content))
+            try:
+                if content is not None:
+                    with self.loadmanager(priority=PRIORITY_HIGH, force=True):
+                        if hasattr(self, "page_post_hook"):
+                            with self.span("page_post_hook"):
+                                self.page_post_hook(content)
+                        with self.span("encode"):
+                            content = self.encode(content)
+            finally:
+                if self.tracer is not None:
+                    self.tracer.end()
+            if content is not None and self.pagecache is not None:
+                expires = self.roundedtime(self.page_cache_days) + self.page_cache_days*86400
+                self.pagecache.put(key, content, expires)
+            if content is not None and self.overload_pool is not None:
+                self.overload_pool.add(content)
+
+        return Response(_Stream(chunks, copy_current_request_context(done), keep), mimetype="text/html")
+
+    # Generate the rest of a streamed page's pieces one at a time under
+    # the load manager, which is left while each is sent. CPU is still
+    # charged for the whole page, but one slow client can't hold up
+    # everything else. Pages that have been started go ahead of new
+    # ones, and are never turned away.
+    def metered(self, chunks):
+        while True:
+            with self.loadmanager(priority=PRIORITY_HIGH, force=True), self.app_context():
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    # Background thread which tops up the overload pool with pages
+    # from random dated links.
+    def refill_overload_pool(self):
+        rng = random.Random()
+        while True:
+            time.sleep(self.overload_refill_interval)
+            if self.loadmanager.waiting() > 0:
+                continue
+
+            start = time.thread_time()
+            _, _, location = self.datedlink(rng.randint(self.blog_start_date, int(time.time())), rng=rng)
+            try:
+                with self.loadmanager(priority=PRIORITY_LOW), self.app_context():
+                    content = self.encode(self.generate_page(location))
+            except queue.Full:
+                continue
+            self.overload_pool.add(content)
+
+            # Sleep long enough to keep this thread's CPU usage down
+            # to the requested percentage (none at all, if that's over 100).
+            cpu = time.thread_time() - start
+            time.sleep(max(0, cpu*100/self.overload_cpu_percent - cpu))
+
+    # Serve the metrics.
+    def metrics_router(self):
+        return Response(self.metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    # Handle a request we don't have the resources for.
+    def overloaded(self):
+        if self.metrics is not None:
+            self.metric_overloaded.inc()
+        if self.overload_pool is not None:
+            content = self.overload_pool.random()
+            if content is not None:
+                if self.metrics is not None:
+                    self.metric_pool.inc()
+                return content
+
+        if self.metrics is None:
+            return self._overloaded()
+        try:
+            content = self._overloaded()
+        except HTTPException:
+            self.metric_unavailable.inc()
+            raise
+        self.metric_hook.inc()
+        return content
+
+    # The rest of overloaded(): use abort_hook if there is one, otherwise
+    # give a 503.
+    def _overloaded(self):
+        if hasattr(self, "abort_hook"):
+            # abort_hook can now return either a string or 
+            # a http code and a string. In the latter case,
+            # if the code is 200 then a normal return is
+            # done with the content, else the code is passed
+            # to abort along with the content.
+            hook_output = self.abort_hook()
+            if isinstance(hook_output, str):
+                abort(503, hook_output)
+            elif isinstance(hook_output, tuple) or isinstance(hook_output, list):
+                code, content = hook_output
+                if code != 200:
+                    abort(code, content)
                 else:
-                    abort(503, "Try again later")
+                    return content
             else:
                 abort(503, "Try again later")
+        else:
+            abort(503, "Try again later")
 
-    def page(self, location):
+    # Work out the jinja tags for a page, apart from its text. Returns
+    # the tags and the random.Random() instance to carry on with.
+    #
+    # The markov argument here and below is the model to use, so that a
+    # page is generated from one model even if it's reloaded meanwhile.
+    def pagetags(self, location, markov=None):
         # Seed the random number generator based on the
         # location string. That means each "url" will have
         # the same Markov output.
@@ -190,7 +1107,8 @@ class Spigot(Flask):
         # The line below is fairly horrible, but ensures that all
         # parts of the location contribute to seeding the random number
         # generator.
-        rng = random.Random(struct.unpack("L", hashlib.md5(location.encode("utf-8")).digest()[:8])[0])
+        with self.span("seed"):
+            rng = (markov or self.markov).rng(struct.unpack("L", hashlib.md5(location.encode("utf-8")).digest()[:8])[0])
         current_url = location
 
         # If the location looks like a dated article of the form  
@@ -218,16 +1136,19 @@ class Spigot(Flask):
                 capitalize(). \
                 replace(" i ", " I "). \
                 replace(" i'", "I'")
-        page_title, _, _ = self.datedlink(time.time(), seedtitle, target_len=60, rng=rng)
+        with self.span("title"):
+            page_title, _, _ = self.datedlink(time.time(), seedtitle, target_len=60, rng=rng, markov=markov)
 
         # Generate short Markov output to make "earlier" and "later" links.
-        earlier, date, earlier_url = self.datedlink(stamp - rng.randint(86400*2, 86400*30), rng=rng)
-        later, date, later_url =  self.datedlink(stamp + rng.randint(86400*2, 86400*30), rng=rng)
+        with self.span("links"):
+            earlier, date, earlier_url = self.datedlink(stamp - rng.randint(86400*2, 86400*30), rng=rng, markov=markov)
+            later, date, later_url =  self.datedlink(stamp + rng.randint(86400*2, 86400*30), rng=rng, markov=markov)
 
-        # Create an initial list of tags for jinja.
+        # Create an initial list of tags for jinja. The text is filled
+        # in by the caller.
         tags = {
             "top_url":     self.top_url,
-            "markov_text": self.pagetext(rng),
+            "markov_text": None,
             "title":       page_title,
             "pagedate":    page_date,
             "current":     page_title,
@@ -237,17 +1158,55 @@ class Spigot(Flask):
             "earlier_url": earlier_url, 
             "later_url":   later_url,
         }
+        return tags, rng
+
+    def page(self, location, markov=None):
+        markov = markov or self.markov
+        tags, rng = self.pagetags(location, markov)
+        with self.span("pagetext"):
+            tags["markov_text"] = self.pagetext(rng, markov)
 
         # Call page_pre_hook, which might change or augment tags.
         if hasattr(self, "page_pre_hook"):
-            self.page_pre_hook(tags, rng)
+            with self.span("page_pre_hook"):
+                self.page_pre_hook(tags, rng)
                 
         # Finally, render the "page" template, using what we've gathered.
-        return render_template("page.tpl", **tags)
+        with self.span("render"):
+            return render_template("page.tpl", **tags)
+
+    # The streamed version of page(), returning an iterator over pieces
+    # of the page. The template is rendered straight away, with a marker
+    # in place of the text, and paragraphs are generated as the iterator
+    # is consumed.
+    #
+    # Each paragraph's link is made as soon as the paragraph has been
+    # generated, rather than after all of them, so the random numbers
+    # are used in a different order and the text differs from page()'s.
+    # It's still the same each time for a given URL. Note page_pre_hook
+    # is called before the text is generated, with the marker in
+    # markov_text; if the hook replaces it, no text is added.
+    STREAM_MARKER = "\0markov_text\0"
+
+    def page_stream(self, location, markov=None):
+        markov = markov or self.markov
+        tags, rng = self.pagetags(location, markov)
+        tags["markov_text"] = self.STREAM_MARKER
+
+        if hasattr(self, "page_pre_hook"):
+            with self.span("page_pre_hook"):
+                self.page_pre_hook(tags, rng)
+
+        with self.span("render"):
+            content = render_template("page.tpl", **tags)
+        head, marker, tail = content.partition(self.STREAM_MARKER)
+        if not marker:
+            return iter([content])
+        return chain([head], self.pagetext_stream(rng, markov), [tail])
 
     # This generates a page title, a formatted date and
     # a link of the form 2025/01/02/title/.
-    def datedlink(self, stamp, seed_text=None, rng=random, target_len=30):
+    def datedlink(self, stamp, seed_text=None, rng=random, target_len=30, markov=None):
         if stamp < self.blog_start_date or stamp > time.time():
             return None, None, None
 
@@ -255,13 +1214,25 @@ class Spigot(Flask):
 
         # We expect the link title to be truncated for display, so just
         # collect a few words.
-        words = self.markov.generate(0, seed_text, rng=rng)[:-1].replace("/", " ").split()
+        markov = markov or self.markov
+        if self.short_link_titles:
+            text = ""
+            for piece in markov.sentence(seed_text, rng):
+                text += piece
+                if sum(len(word)+1 for word in text.replace("/", " ").split()) >= target_len:
+                    break
+        else:
+            text = markov.generate(0, seed_text, rng=rng)
+        if text.endswith("."):
+            text = text[:-1]
+        words = text.replace("/", " ").split()
         title = []
         title_len = 0
-        while len(words) > 0 and title_len < target_len:
-            title_len += len(words[0])+1
-            title.append(words[0])
-            words = words[1:]
+        for word in words:
+            if title_len >= target_len:
+                break
+            title_len += len(word)+1
+            title.append(word)
         title = " ".join(title)
 
         date = dt.strftime("%Y-%m-%d")
@@ -277,30 +1248,42 @@ class Spigot(Flask):
         return rng.randint(self.min_page_len, self.max_page_len)
 
     # Create the "markov" tag - a number of paragraphs.
-    def pagetext(self, rng=random):
-        text = ""
-        paragraphs = self.markov.generate(self.targetlength(rng), rng=rng)
+    def pagetext(self, rng=random, markov=None):
+        text = []
+        paragraphs = (markov or self.markov).generate(self.targetlength(rng), rng=rng)
         for para in paragraphs:
-            # Add a realistic link to each paragraph.
-            pos = rng.randint(0, len(para))
-
-            # Match into:
-            #     (1) the first {pos} characters,
-            #     (2) any non-whitespace characters,
-            #     (3) any whitespace characters,
-            #     (4) two wordlike things
-            #     (5) the rest of the string.
-            # We'll glue the first three together, stick an "a href" around
-            # the fourth, glue the fifth back on and skip pos to just after
-            # where we modified.
-            m = re.match(r"^(.{"+str(pos)+"}\S*\s+)([A-Za-z']+\s+[a-z']+)(\s+.*)$", para, re.S)
-            if m:
-                # Don't make links on short text.
-                if len(m.group(2)) > 3:
-                    _, _, url = self.datedlink(rng.randint(self.blog_start_date, self.roundedtime(90)), rng=rng)
-                    para = m.group(1) + f"""<a href="{self.top_url}/{url}/">{m.group(2)}</a>""" + m.group(3)
-            text += "<p>\n" + para + "\n"
-        return text
+            text.append("<p>\n")
+            text.append(self.linkparagraph(para, rng, markov))
+            text.append("\n")
+        return "".join(text)
+
+    # As above, yielding each paragraph as it's generated.
+    def pagetext_stream(self, rng=random, markov=None):
+        for para in (markov or self.markov).paragraphs(self.targetlength(rng), rng=rng):
+            yield "<p>\n" + self.linkparagraph(para, rng, markov) + "\n"
+
+    # Where to put a link, matched from a random position in a paragraph:
+    # any non-whitespace characters, any whitespace characters, then
+    # two wordlike things (the link text, group 1) and some whitespace.
+    LINK_PLACE = re.compile(r"\S*\s+([A-Za-z']+\s+[a-z']+)\s", re.S)
+
+    # Add a realistic link to a paragraph.
+    def linkparagraph(self, para, rng=random, markov=None):
+        pos = rng.randint(0, len(para))
+
+        # Match from pos, and stick an "a href" around the two words.
+        # None of the parts can match less than they do, so this finds
+        # the same place as matching the whole paragraph against
+        # "^(.{pos}\S*\s+)([A-Za-z']+\s+[a-z']+)(\s+.*)$" would, without
+        # compiling a new pattern for each pos.
+        m = self.LINK_PLACE.match(para, pos)
+        if m:
+            # Don't make links on short text.
+            if len(m.group(1)) > 3:
+                _, _, url = self.datedlink(rng.randint(self.blog_start_date, self.roundedtime(90)), rng=rng, markov=markov)
+                start, end = m.span(1)
+                para = para[:start] + f"""<a href="{self.top_url}/{url}/">{m.group(1)}</a>""" + para[end:]
+        return para
 
     # Generate a timestamp value, rounded to a specified
     # number of days. e.g. roundedtime(31) would return 
@@ -0,0 +1,136 @@
+# Usage:
+#
+# spigot = Spigot(top_url, ...)
+# application = Tarpit(spigot, chunk_size = 256, chunk_delay = 2)
+#
+# An ASGI application serving the same pages as the Spigot (Flask) one,
+# but dripping each page out chunk_size bytes at a time, chunk_delay
+# seconds apart. Under mod_wsgi, every request ties up a thread for as
+# long as it takes to send; here a connection costs a coroutine, so an
+# ASGI server (uvicorn, hypercorn, etc.) can hold thousands of slow
+# crawlers at once.
+#
+# Pages are generated on a pool of max_workers threads, through the
+# Spigot's load manager, so its CPU target still applies. If more than
+# max_pending pages are waiting to be generated, we're overloaded and the
+# Spigot's overloaded() handling is used straight away. Cached pages are
+# returned without using the thread pool at all.
+#
+import asyncio
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import HTTPException
+
+from compression import EncodedPage
+
+class Tarpit:
+    def __init__(self, spigot, chunk_size=256, chunk_delay=2.0, max_workers=4, max_pending=16):
+        self.spigot = spigot
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.max_pending = max_pending
+        self.pending = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    self.executor.shutdown(wait=False)
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        if scope["method"] not in ("GET", "HEAD"):
+            status, body = 405, b"Method not allowed"
+        else:
+            path = scope["path"]
+            root = scope.get("root_path", "")
+            if root and path.startswith(root):
+                path = path[len(root):]
+            status, body = await self.content(path.lstrip("/"))
+
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"text/html; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        })
+        if scope["method"] == "HEAD":
+            body = b""
+        await self.drip(body, receive, send)
+
+    # Get the status and body for a location.
+    async def content(self, location):
+        pagecache = self.spigot.pagecache
+        if location and pagecache is not None:
+            content = pagecache.get(self.spigot.cache_key(location))
+            if content is not None:
+                return 200, self.body(content)
+
+        if self.pending >= self.max_pending:
+            return self.render(None)
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self.render, location)
+        finally:
+            self.pending -= 1
+
+    # Generate a page (or the overloaded response, if location is None)
+    # in the Spigot's application context. Runs on the thread pool.
+    def render(self, location):
+        with self.spigot.app_context():
+            try:
+                try:
+                    if location is None:
+                        content = self.spigot.overloaded()
+                    elif location == "":
+                        top = self.spigot.top_entry()
+                        content = top["content"] if top is not None else self.spigot.overloaded()
+                    else:
+                        content = self.spigot.serve_page(location)
+                except queue.Full:
+                    content = self.spigot.overloaded()
+            except HTTPException as e:
+                return e.code, e.get_response().get_data()
+        return 200, self.body(content)
+
+    # The uncompressed body for some content, which might be an
+    # EncodedPage if the Spigot compresses pages.
+    def body(self, content):
+        if isinstance(content, EncodedPage):
+            return content.body()
+        return content.encode("utf-8")
+
+    # Send the body slowly, giving up if the client goes away.
+    async def drip(self, body, receive, send):
+        disconnected = asyncio.Event()
+        async def watch():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+        watcher = asyncio.ensure_future(watch())
+        try:
+            for pos in range(0, len(body), self.chunk_size):
+                if pos > 0:
+                    try:
+                        await asyncio.wait_for(disconnected.wait(), self.chunk_delay)
+                        return
+                    except asyncio.TimeoutError:
+                        pass
+                await send({
+                    "type": "http.response.body",
+                    "body": body[pos:pos+self.chunk_size],
+                    "more_body": True,
+                })
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            watcher.cancel()
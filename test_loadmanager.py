@@ -0,0 +1,115 @@
+# Usage:
+#
+# python3 -m unittest test_loadmanager        (or pytest)
+#
+# Checks the LoadManager's admission rules (priorities, max_wait,
+# max_queue_len and force) and that it holds CPU-bound work to its
+# target. The timings are generous, so this shouldn't fail on a busy
+# machine, but the CPU target test does take a couple of seconds.
+#
+import queue
+import threading
+import time
+import unittest
+
+from loadmanager import LoadManager, Expired, PRIORITY_HIGH, PRIORITY_LOW
+
+# Hold lm's one slot in another thread until the returned event is set.
+def hold(lm):
+    entered = threading.Event()
+    release = threading.Event()
+    def run():
+        with lm:
+            entered.set()
+            release.wait()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    entered.wait()
+    return thread, release
+
+# Wait for n threads to be waiting for or holding a slot.
+def wait_for(lm, n):
+    deadline = time.monotonic() + 10
+    while lm.waiting() != n:
+        if time.monotonic() > deadline:
+            raise Exception(f"Expected {n} threads in the queue, not {lm.waiting()}")
+        time.sleep(0.01)
+
+# Use lm from another thread, recording name in order when it gets a slot.
+def use(lm, order, name, **kwargs):
+    def run():
+        with lm(**kwargs):
+            order.append(name)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+class TestAdmission(unittest.TestCase):
+    def test_priority(self):
+        lm = LoadManager(target_pcpu=10**6)
+        holder, release = hold(lm)
+        order = []
+        threads = [use(lm, order, "low", priority=PRIORITY_LOW)]
+        wait_for(lm, 2)
+        threads.append(use(lm, order, "normal"))
+        wait_for(lm, 3)
+        threads.append(use(lm, order, "high", priority=PRIORITY_HIGH))
+        wait_for(lm, 4)
+        release.set()
+        for thread in [holder] + threads:
+            thread.join()
+        self.assertEqual(order, ["high", "normal", "low"])
+        self.assertEqual(lm.waiting(), 0)
+
+    def test_max_wait(self):
+        lm = LoadManager(target_pcpu=10**6)
+        holder, release = hold(lm)
+        start = time.monotonic()
+        with self.assertRaises(Expired):
+            with lm(max_wait=0.2):
+                pass
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(lm.expired, 1)
+        self.assertEqual(lm.waiting(), 1)
+        release.set()
+        holder.join()
+        self.assertEqual(lm.waiting(), 0)
+
+        # The slot is still usable after a thread's given up on it.
+        with lm(max_wait=0.2):
+            pass
+        self.assertEqual(lm.expired, 1)
+
+    def test_max_queue_len(self):
+        lm = LoadManager(max_queue_len=2, target_pcpu=10**6)
+        holder, release = hold(lm)
+        order = []
+        threads = [use(lm, order, "queued")]
+        wait_for(lm, 2)
+        with self.assertRaises(queue.Full) as cm:
+            with lm:
+                pass
+        self.assertNotIsInstance(cm.exception, Expired)
+        self.assertEqual(lm.waiting(), 2)
+
+        threads.append(use(lm, order, "forced", force=True))
+        wait_for(lm, 3)
+        release.set()
+        for thread in [holder] + threads:
+            thread.join()
+        self.assertEqual(order, ["queued", "forced"])
+        self.assertEqual(lm.waiting(), 0)
+
+class TestCPUTarget(unittest.TestCase):
+    def test_half_cpu(self):
+        lm = LoadManager(target_pcpu=50)
+        cpu = 0.2
+        start = time.monotonic()
+        for _ in range(3):
+            with lm:
+                end = time.thread_time() + cpu
+                while time.thread_time() < end:
+                    pass
+        elapsed = time.monotonic() - start
+        self.assertGreater(elapsed, 3*cpu * 1.8)
+        self.assertLess(elapsed, 3*cpu * 2.6)
@@ -0,0 +1,110 @@
+# Usage:
+#
+# python3 -m unittest test_output        (or pytest)
+#
+# Checks that the text and pages generated for a given seed or URL
+# haven't changed. Every URL's content is meant to stay the same from
+# one version to the next, so the digests below are of the output of
+# the original, dict based implementation, and each backend (dict,
+# compact and snapshot) has to match them, as do the page cache,
+# compress_pages and short_link_titles' sentence(). Anything that's
+# meant to change the text, like markov_collapse_runs, has to be an
+# option, and isn't covered here.
+#
+# The clock and time zone are fixed, so the pages don't depend on when
+# or where this is run.
+#
+import hashlib
+import json
+import os
+import random
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from markovchain import MarkovChain
+
+os.environ["TZ"] = "UTC"
+time.tzset()
+
+HOME = os.path.dirname(os.path.realpath(__file__))
+CORPUS = f"{HOME}/markov_input.txt"
+NOW = 1760000000.0
+
+MEMORIES = (1, 3, 8)
+SEEDS = (1, 2, 3)
+LOCATIONS = ("", "2020/01/03/hello_world/", "foo", "2024/02/29/a/", "2025/10/01/recent_post/", "x/y/z")
+
+GENERATE_DIGESTS = {
+    1: "47689e84e0feb5eac182da40c0cfdbfaff9ba57534a39e6e75c157111c4c3553",
+    3: "00f427e24b844cb04beb21682c3eaf23028a83ec07cbceb6dd0fed4c9135ffa7",
+    8: "b1be7ada4555da9625e6a1322f946a55e43a6bb032d1fa839980b41d8fa95ba9",
+}
+PAGES_DIGEST = "d5e733227eefdd98937b5f99bb014b4c48330fd49b933dbd923b7e3255e7a776"
+
+def digest(texts):
+    return hashlib.sha256(json.dumps(texts).encode("utf-8")).hexdigest()
+
+# A fixed mix of generate() calls: whole texts, single sentences, and
+# seed texts that are long, short, empty and not in the corpus.
+def outputs(mc):
+    texts = []
+    for seed in SEEDS:
+        rng = random.Random(seed)
+        texts.append(mc.generate(3000, rng=rng))
+        texts.append(mc.generate(0, rng=rng))
+        texts.append(mc.generate(500, "Sherlock Holmes said", rng=rng))
+        texts.append(mc.generate(0, "Sh", rng=rng))
+        texts.append(mc.generate(0, "", rng=rng))
+        texts.append(mc.generate(0, "zzqx", rng=rng))
+    return texts
+
+def pages(**kwargs):
+    from spigot import Spigot
+    app = Spigot("http://x/s", blog_start_date=1300000000, home_dir=HOME, **kwargs)
+    client = app.test_client()
+    return [client.get("/" + location).get_data(as_text=True) for location in LOCATIONS]
+
+class TestGenerate(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_backends(self):
+        for memory in MEMORIES:
+            with self.subTest(memory=memory):
+                expected = outputs(MarkovChain(CORPUS, memory))
+                self.assertEqual(digest(expected), GENERATE_DIGESTS[memory])
+                self.assertEqual(outputs(MarkovChain(CORPUS, memory, compact=True)), expected)
+                snapshot = os.path.join(self.tmp.name, f"m{memory}.snap")
+                mc = MarkovChain.load(CORPUS, memory, snapshot=snapshot)
+                self.assertTrue(hasattr(mc, "_mmap"))
+                self.assertEqual(outputs(mc), expected)
+
+    def test_sentence(self):
+        for compact in (False, True):
+            mc = MarkovChain(CORPUS, 8, compact=compact)
+            for seed in range(50):
+                for seed_text in (None, "Sherlock", "The cat"):
+                    sentence = "".join(mc.sentence(seed_text, random.Random(seed)))
+                    self.assertEqual(sentence, mc.generate(0, seed_text, rng=random.Random(seed)))
+
+@mock.patch("time.time", return_value=NOW)
+class TestPages(unittest.TestCase):
+    def test_pages(self, _):
+        self.assertEqual(digest(pages()), PAGES_DIGEST)
+
+    def test_backends(self, _):
+        expected = pages()
+        self.assertEqual(pages(markov_compact=True), expected)
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertEqual(pages(markov_snapshot=os.path.join(tmp, "m8.snap")), expected)
+
+    def test_options(self, _):
+        expected = pages()
+        self.assertEqual(pages(page_cache_bytes=10**7, compress_pages=True), expected)
@@ -0,0 +1,45 @@
+# Usage:
+#
+# python3 -m unittest test_pool        (or pytest)
+#
+# Checks that pages are still served when a worker process dies, as it
+# might if it's killed for using too much memory, and that the pool is
+# then replaced.
+#
+import os
+import signal
+import tempfile
+import time
+import unittest
+
+from spigot import Spigot
+
+HOME = os.path.dirname(os.path.realpath(__file__))
+
+class TestBrokenPool(unittest.TestCase):
+    def test_worker_killed(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        snapshot = os.path.join(tmp.name, "m8.snap")
+        app = Spigot("http://x/s", home_dir=HOME, markov_snapshot=snapshot, generation_processes=2, max_cpu_percent=10**6)
+        broken = app.generation_pool
+        try:
+            client = app.test_client()
+            expected = client.get("/2020/01/03/hello_world/").get_data(as_text=True)
+
+            os.kill(broken.submit(os.getpid).result(), signal.SIGKILL)
+            for n in range(3):
+                response = client.get("/2020/01/03/hello_world/")
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.get_data(as_text=True), expected)
+
+            deadline = time.monotonic() + 120
+            while app.generation_pool in (None, broken) and time.monotonic() < deadline:
+                time.sleep(0.1)
+            self.assertNotIn(app.generation_pool, (None, broken))
+            response = client.get("/2020/01/03/hello_world/")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_data(as_text=True), expected)
+        finally:
+            if app.generation_pool is not None:
+                app.generation_pool.shutdown()
@@ -0,0 +1,140 @@
+# Usage:
+#
+# tracer = Tracer(sample_rate = 0.01, slow_seconds = 2, logger = app.logger, metrics = metrics)
+#
+# # In the thread handling a request:
+# with tracer.trace(location, version):
+#     with tracer.span("render"):
+#         render_the_page()
+#     tracer.record("sleep", seconds)     # for a phase timed elsewhere
+#
+# Times the phases of generating a page, for a sample_rate fraction of
+# requests. Spans are kept in a thread-local trace, so they can be
+# dropped into code anywhere below trace() without passing anything
+# around. Outside a sampled trace, span() returns a do-nothing context
+# and record() returns straight away, so they cost next to nothing.
+#
+# When a sampled trace finishes, each phase's time (summed, if it
+# occurs more than once) and the total are added to per-phase
+# histograms, registered with metrics if given, as
+# <prefix>phase_<name>_seconds; summary() returns the same aggregates as
+# a dict. If the total is slow_seconds or more, a JSON line giving the
+# location, model version, total and phase times is logged as a
+# warning. Traces that end with an exception are thrown away.
+#
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from metrics import Histogram, TIME_BUCKETS
+
+NULL_SPAN = nullcontext()
+
+class _Span:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, type, value, traceback):
+        self.trace.add(self.name, time.perf_counter() - self.start)
+
+class _Trace:
+    def __init__(self, location, version):
+        self.location = location
+        self.version = version
+        self.start = time.perf_counter()
+        self.phases = {}
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+class Tracer:
+    def __init__(self, sample_rate=0.01, slow_seconds=None, logger=None, metrics=None, buckets=TIME_BUCKETS):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.logger = logger
+        self.metrics = metrics
+        self.buckets = buckets
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.rng = random.Random()
+
+    # Start a trace in this thread, if this request is sampled.
+    def begin(self, location, version):
+        if self.rng.random() < self.sample_rate:
+            self.local.trace = _Trace(location, version)
+        else:
+            self.local.trace = None
+
+    # Finish this thread's trace, keeping it unless discard is set.
+    def end(self, discard=False):
+        trace = getattr(self.local, "trace", None)
+        self.local.trace = None
+        if trace is None or discard:
+            return
+        total = time.perf_counter() - trace.start
+        for name, seconds in trace.phases.items():
+            self.histogram(name).observe(seconds)
+        self.histogram("total").observe(total)
+
+        if self.slow_seconds is not None and total >= self.slow_seconds and self.logger is not None:
+            self.logger.warning(json.dumps({
+                "event": "slow_page",
+                "location": trace.location,
+                "version": trace.version,
+                "total": round(total, 6),
+                "phases": {name: round(seconds, 6) for name, seconds in trace.phases.items()},
+            }))
+
+    @contextmanager
+    def trace(self, location, version):
+        self.begin(location, version)
+        try:
+            yield
+        except BaseException:
+            self.end(discard=True)
+            raise
+        self.end()
+
+    # Time a phase of this thread's trace, if there is one.
+    def span(self, name):
+        trace = getattr(self.local, "trace", None)
+        if trace is None:
+            return NULL_SPAN
+        return _Span(trace, name)
+
+    # Add a phase timed some other way to this thread's trace.
+    def record(self, name, seconds):
+        trace = getattr(self.local, "trace", None)
+        if trace is not None:
+            trace.add(name, seconds)
+
+    # The histogram for a phase, created the first time it's seen.
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    help = f"Time spent in the {name} phase of sampled pages"
+                    if self.metrics is not None:
+                        histogram = self.metrics.histogram(f"phase_{name}_seconds", help, self.buckets)
+                    else:
+                        histogram = Histogram(f"phase_{name}_seconds", help, self.buckets)
+                    self.histograms[name] = histogram
+        return histogram
+
+    # Count, total and mean seconds for each phase so far.
+    def summary(self):
+        summary = {}
+        for name, histogram in list(self.histograms.items()):
+            with histogram.lock:
+                count, total = histogram.count, histogram.sum
+            summary[name] = {"count": count, "seconds": total, "mean": total / count if count else 0}
+        return summary